@@ -0,0 +1,136 @@
+import gzip
+import os
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+
+# adapters planted into synthetic reads, matching the names in example_inputs/known_adapters.fa
+ADAPTERS = {
+    "Illumina_Universal_Adapter": "AGATCGGAAGAG",
+    "Nextera_Transposase_Sequence": "CTGTCTCTTATA",
+}
+# summary rows at the top of every STAR ReadsPerGene table
+STAR_SUMMARY_ROWS = ["N_unmapped", "N_multimapping", "N_noFeature", "N_ambiguous"]
+
+
+def sample_names(n_samples: int, prefix: str = "bench") -> List[str]:
+    # zero padded so glob order and sorted order agree
+    return [f"{prefix}{i:05d}_" for i in range(n_samples)]
+
+
+def generate_fastqs(
+    directory: str,
+    n_samples: int,
+    n_reads: int,
+    read_length: int = 100,
+    r1: str = "read1",
+    r2: str = "read2",
+    fastq_suffix: str = ".fastq.gz",
+    seed: int = 0,
+) -> List[Tuple[str, str]]:
+    # write gzipped paired FASTQs with an adapter read-through in a fraction of reads
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    quality = b"I" * read_length
+    filenames = []
+    for sample in sample_names(n_samples):
+        pair = []
+        for read, adapter in zip([r1, r2], ADAPTERS.values()):
+            filename = os.path.join(directory, f"{sample}{read}{fastq_suffix}")
+            sequences = bases[rng.integers(0, 4, size=(n_reads, read_length))]
+            # plant the adapter at a random insert size in a quarter of the reads
+            for idx in np.flatnonzero(rng.random(n_reads) < 0.25):
+                start = rng.integers(read_length // 2, read_length - len(adapter))
+                sequences[idx, start : start + len(adapter)] = np.frombuffer(adapter.encode(), dtype=np.uint8)
+            with gzip.open(filename, "wb", compresslevel=1) as f:
+                for idx in range(n_reads):
+                    f.write(b"@%s%d\n%s\n+\n%s\n" % (sample.encode(), idx, sequences[idx].tobytes(), quality))
+            pair.append(filename)
+        filenames.append(tuple(pair))
+    return filenames
+
+
+def generate_count_files(
+    directory: str,
+    n_samples: int,
+    n_genes: int,
+    count_suffix: str = "_ReadsPerGene.out.tab",
+    seed: int = 0,
+) -> List[str]:
+    # write STAR ReadsPerGene tables with negative binomial counts
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    genes = [f"ENSGBENCH{i:011d}" for i in range(n_genes)]
+    means = rng.lognormal(mean=3, sigma=2, size=n_genes)
+    filenames = []
+    for sample in sample_names(n_samples):
+        counts = rng.negative_binomial(n=5, p=5 / (5 + means[:, None]), size=(n_genes, 3))
+        summary = rng.integers(1000, 100000, size=(len(STAR_SUMMARY_ROWS), 3))
+        df = pd.DataFrame(np.vstack([summary, counts]), index=STAR_SUMMARY_ROWS + genes)
+        filename = os.path.join(directory, f"{sample}{count_suffix}")
+        df.to_csv(filename, sep="\t", header=False)
+        filenames.append(filename)
+    return filenames
+
+
+def generate_adapter_stats(
+    directory: str,
+    n_samples: int,
+    r1: str = "read1",
+    r2: str = "read2",
+    known_adapter_suffix: str = ".adapters_stats.txt",
+    seed: int = 0,
+) -> str:
+    # write bbduk.sh stats for each read and the known adapter FASTA they refer to
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for sample in sample_names(n_samples):
+        for read in [r1, r2]:
+            total = int(rng.integers(100000, 1000000))
+            matched = rng.integers(0, total // 10, size=len(ADAPTERS))
+            with open(os.path.join(directory, f"{sample}{read}{known_adapter_suffix}"), "w") as f:
+                f.write(f"#File\t{sample}{read}.fastq.gz\n#Total\t{total}\n#Matched\t{matched.sum()}\t{100 * matched.sum() / total:.5f}%\n#Name\tReads\tReadsPct\n")
+                for name, reads in zip(ADAPTERS, matched):
+                    f.write(f"{name}\t{reads}\t{100 * reads / total:.5f}%\n")
+    known_adapter_filename = os.path.join(directory, "known_adapters.fa")
+    with open(known_adapter_filename, "w") as f:
+        for name, sequence in ADAPTERS.items():
+            f.write(f">{name}\n{sequence}\n")
+    return known_adapter_filename
+
+
+def generate_cellphonedb(
+    directory: str,
+    n_genes: int,
+    n_interactions: int,
+    n_samples: int,
+    seed: int = 0,
+) -> Tuple[str, str]:
+    # write CellPhoneDB-shaped tables and a matching (genes x samples) expression matrix
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    protein_ids = np.arange(1, n_genes + 1)
+    gene_names = [f"GENE{i}" for i in protein_ids]
+    pd.DataFrame({"protein_id": protein_ids, "gene_name": gene_names}).to_csv(os.path.join(directory, "gene_table.csv"), index=False)
+    partners = rng.choice(protein_ids, size=(n_interactions, 2))
+    pd.DataFrame({"multidata_1_id": partners[:, 0], "multidata_2_id": partners[:, 1]}).to_csv(os.path.join(directory, "interaction_table.csv"), index=False)
+    pd.DataFrame(columns=["complex_multidata_id", "protein_multidata_id"]).to_csv(os.path.join(directory, "complex_composition_table.csv"), index=False)
+    expression = pd.DataFrame(
+        rng.lognormal(mean=1, sigma=1, size=(n_genes, n_samples)),
+        index=gene_names,
+        columns=[sample.rstrip("_") for sample in sample_names(n_samples)],
+    )
+    expression_file = os.path.join(directory, "expr.csv")
+    expression.to_csv(expression_file)
+    return directory, expression_file
+
+
+def generate_tx2gene(directory: str, n_genes: int) -> str:
+    # transcript to gene table of the stub pseudo-aligners, two transcripts per gene
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, "tx2gene.tsv")
+    pd.DataFrame(
+        {"transcript": [f"TX{i}.1" for i in range(2 * n_genes)], "gene": [f"GENE{i // 2}" for i in range(2 * n_genes)]}
+    ).to_csv(filename, sep="\t", header=False, index=False)
+    return filename
@@ -0,0 +1,257 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import yaml
+from typing import Callable, Dict
+
+# make the pipeline and scripts importable from the repository root
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.join(REPOSITORY, "scripts"))
+import main as pipeline
+import ligandreceptor
+from constants import PIPELINE_STEPS
+from generators import (
+    generate_adapter_stats,
+    generate_cellphonedb,
+    generate_count_files,
+    generate_fastqs,
+    generate_tx2gene,
+)
+from stubs import GENES_VARIABLE, LATENCY_VARIABLE, install_stubs
+
+# default sizes of the synthetic data for each scale
+SCALES = {
+    "small": {"n_samples": 4, "n_reads": 1000, "n_genes": 2000, "n_interactions": 500},
+    "medium": {"n_samples": 48, "n_reads": 10000, "n_genes": 20000, "n_interactions": 2000},
+    "large": {"n_samples": 400, "n_reads": 50000, "n_genes": 60000, "n_interactions": 3000},
+}
+
+
+def measure(func: Callable, **kwargs) -> Dict:
+    # time a call and track the peak python allocations and resident memory
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(**kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "seconds": seconds,
+        "peak_traced_mb": peak / 1024 ** 2,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "max_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def bench_generate_count_matrix(workspace: str, params: Dict) -> Dict:
+    count_directory = os.path.join(workspace, "counts")
+    generate_count_files(directory=count_directory, n_samples=params["n_samples"], n_genes=params["n_genes"])
+    return measure(
+        pipeline.generate_count_matrix,
+        count_suffix="_ReadsPerGene.out.tab",
+        count_directory=count_directory,
+        output_directory=os.path.join(workspace, "outputs"),
+        output_filename="raw_counts.tsv",
+    )
+
+
+def bench_quantify_adapters(workspace: str, params: Dict) -> Dict:
+    output_directory = os.path.join(workspace, "adapter_detection")
+    known_adapter_filename = generate_adapter_stats(directory=output_directory, n_samples=params["n_samples"])
+    return measure(
+        pipeline.quantify_adapters,
+        r1_fastq_suffix="read1.fastq.gz",
+        r2_fastq_suffix="read2.fastq.gz",
+        fastq_suffix=".fastq.gz",
+        known_adapter_suffix=".adapters_stats.txt",
+        known_adapter_filename=known_adapter_filename,
+        output_directory=output_directory,
+    )
+
+
+def bench_score_interactions(workspace: str, params: Dict) -> Dict:
+    cellphonedb_directory, expression_file = generate_cellphonedb(
+        directory=os.path.join(workspace, "cellphonedb"),
+        n_genes=params["n_genes"],
+        n_interactions=params["n_interactions"],
+        n_samples=params["n_samples"],
+    )
+    # prepare the profiles the same way ligandreceptor.py does before scoring
+    df_intrxn, df_gene, df_complex, _ = ligandreceptor.retrieve_cellphonedb(cellphonedb_directory=cellphonedb_directory)
+    df = ligandreceptor.pd.read_csv(expression_file, index_col=0)
+    df_gene, df_complex = ligandreceptor.filter_cellphonedb(df_gene=df_gene, df_complex=df_complex, df=df)
+    df_profile, p2g = ligandreceptor.calculate_expression(df_gene=df_gene, df_complex=df_complex, df=df.T)
+    return measure(ligandreceptor.score_interactions, df_intrxn=df_intrxn, df_profile=df_profile, p2g=p2g)
+
+
+def run_pipeline(configs: Dict) -> None:
+    # mirror the loop in main.main without touching the status file
+    for step in PIPELINE_STEPS:
+        if pipeline.skip_step(pipeline_step=step, configs=configs):
+            continue
+        configs.update(pipeline.executor(pipeline_step=step, configs=configs))
+
+
+def configure_executor(workspace: str, params: Dict, **overrides) -> Dict:
+    # replace every external tool with a stub of fixed latency
+    bin_directory = install_stubs(bin_directory=os.path.join(workspace, "bin"))
+    os.environ["PATH"] = bin_directory + os.pathsep + os.environ["PATH"]
+    os.environ["PICARD"] = "picard.jar"
+    os.environ[LATENCY_VARIABLE] = str(params["latency"])
+    os.environ[GENES_VARIABLE] = str(params["n_genes"])
+    raw_fastq_directory = os.path.join(workspace, "raw_fastqs")
+    generate_fastqs(directory=raw_fastq_directory, n_samples=params["n_samples"], n_reads=params["n_reads"])
+    # start from the example configuration pointed at the synthetic data
+    with open(os.path.join(REPOSITORY, "example_inputs", "configs.yaml")) as f:
+        configs = yaml.safe_load(f)
+    configs.update(
+        run_directory=os.path.join(workspace, "run"),
+        raw_fastq_directory=raw_fastq_directory,
+        known_adapter_filename=os.path.join(REPOSITORY, "example_inputs", "known_adapters.fa"),
+        reference_genome=workspace,
+        bam_qc_reference=os.devnull,
+        bam_qc_reference_downsampled=os.devnull,
+        **overrides,
+    )
+    return pipeline.configure_config(configs=configs)
+
+
+def bench_executor(workspace: str, params: Dict) -> Dict:
+    configs = configure_executor(workspace=workspace, params=params)
+    return measure(run_pipeline, configs=configs)
+
+
+def bench_executor_pseudo(workspace: str, params: Dict) -> Dict:
+    # pseudo-align with the stub salmon and collapse its transcripts to genes
+    configs = configure_executor(
+        workspace=workspace,
+        params=params,
+        quantification_mode="pseudo",
+        pseudo_aligner="salmon",
+        transcriptome_index=os.path.join(workspace, "salmon_index"),
+        tx2gene_filename=generate_tx2gene(directory=os.path.join(workspace, "reference"), n_genes=params["n_genes"]),
+    )
+    return measure(run_pipeline, configs=configs)
+
+
+BENCHMARKS = {
+    "generate_count_matrix": bench_generate_count_matrix,
+    "quantify_adapters": bench_quantify_adapters,
+    "score_interactions": bench_score_interactions,
+    "executor": bench_executor,
+    "executor_pseudo": bench_executor_pseudo,
+}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results: Dict, baseline_file: str) -> None:
+    # print the speedup of every benchmark against a previous results file
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before, after = baseline["results"][name], result
+        print(
+            f"{name}: {before['seconds']:.3f}s -> {after['seconds']:.3f}s ({before['seconds'] / max(after['seconds'], 1e-9):.2f}x), "
+            f"peak {before['peak_traced_mb']:.1f}MB -> {after['peak_traced_mb']:.1f}MB"
+        )
+
+
+def main():
+    # read in command line arguments
+    parser = argparse.ArgumentParser(description="Benchmark the Bulk Pipeline on synthetic data")
+    parser.add_argument(
+        "-s",
+        "--scale",
+        type=str,
+        default="small",
+        choices=list(SCALES),
+        help="Size of the synthetic data, individual sizes can be overridden below",
+    )
+    parser.add_argument("--n_samples", type=int, default=None, help="Number of synthetic samples")
+    parser.add_argument("--n_reads", type=int, default=None, help="Number of reads per synthetic FASTQ")
+    parser.add_argument("--n_genes", type=int, default=None, help="Number of genes in count tables and CellPhoneDB")
+    parser.add_argument("--n_interactions", type=int, default=None, help="Number of CellPhoneDB interactions")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Seconds each stub tool sleeps for, 0 measures pure orchestration overhead",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmarks",
+        type=str,
+        nargs="+",
+        default=list(BENCHMARKS),
+        choices=list(BENCHMARKS),
+        help="Benchmarks to run",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        type=str,
+        default=None,
+        help="Path to the JSON results, defaults to benchmarks/results/<revision>_<timestamp>.json",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="Path to a previous JSON results file to compare against",
+    )
+    args = parser.parse_args()
+
+    # resolve the data sizes
+    params = dict(SCALES[args.scale], latency=args.latency)
+    for key in ["n_samples", "n_reads", "n_genes", "n_interactions"]:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+
+    # run each benchmark in its own scratch workspace
+    results = {
+        "revision": git_revision(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": params,
+        "results": {},
+    }
+    for name in args.benchmarks:
+        with tempfile.TemporaryDirectory() as workspace:
+            print(f"Running {name}...")
+            results["results"][name] = BENCHMARKS[name](workspace=workspace, params=params)
+            print(f"{name}: {results['results'][name]['seconds']:.3f}s")
+
+    # save the results so versions can be compared
+    output_file = args.output_file
+    if output_file is None:
+        stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        output_file = os.path.join(REPOSITORY, "benchmarks", "results", f"{results['revision']}_{stamp}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_file}")
+    if args.compare is not None:
+        compare(results=results, baseline_file=args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import gzip
+import os
+import random
+import stat
+import sys
+import time
+from typing import Dict, List
+
+# external tools called by main.py that get replaced by this script
+STUB_TOOLS = [
+    "fastqc",
+    "bbmerge.sh",
+    "bbduk.sh",
+    "cutadapt",
+    "STAR",
+    "samtools",
+    "java",
+    "infer_experiment.py",
+    "read_distribution.py",
+    "geneBody_coverage.py",
+    "multiqc",
+    "salmon",
+    "kallisto",
+]
+# environment variables controlling the stubs
+LATENCY_VARIABLE = "BENCHMARK_STUB_LATENCY"
+GENES_VARIABLE = "BENCHMARK_STUB_GENES"
+
+
+def install_stubs(bin_directory: str) -> str:
+    # link every tool name to this script so it can dispatch on the name it was called by
+    os.makedirs(bin_directory, exist_ok=True)
+    script = os.path.abspath(__file__)
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    for tool in STUB_TOOLS:
+        link = os.path.join(bin_directory, tool)
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(script, link)
+    return bin_directory
+
+
+def parse_key_values(args: List[str]) -> Dict[str, str]:
+    # bbtools and picard take key=value arguments
+    return dict(arg.split("=", 1) for arg in args if "=" in arg)
+
+
+def parse_flags(args: List[str]) -> Dict[str, str]:
+    # map each flag to the argument that follows it
+    return {flag: value for flag, value in zip(args, args[1:]) if flag.startswith("-")}
+
+
+def touch(filename: str, content: str = "") -> None:
+    with open(filename, "w") as f:
+        f.write(content)
+
+
+def write_fastq(filename: str) -> None:
+    with gzip.open(filename, "wt") as f:
+        f.write("@stub\nACGT\n+\nIIII\n")
+
+
+def fastqc(args: List[str]) -> None:
+    flags = parse_flags(args)
+    for filename in [arg for arg in args if arg.endswith(".gz")]:
+        prefix = os.path.join(flags["-o"], os.path.basename(filename).split(".")[0])
+        touch(f"{prefix}_fastqc.html")
+        touch(f"{prefix}_fastqc.zip")
+
+
+def bbmerge(args: List[str]) -> None:
+    touch(parse_key_values(args)["outa"], ">stub_adapter\nAGATCGGAAGAG\n")
+
+
+def bbduk(args: List[str]) -> None:
+    # report the first known adapter as found in a fraction of the reads
+    key_values = parse_key_values(args)
+    with open(key_values["ref"]) as f:
+        name = f.readline()[1:].strip()
+    touch(key_values["stats"], f"#File\t{key_values['in']}\n#Total\t1000\n#Matched\t100\t10.00000%\n#Name\tReads\tReadsPct\n{name}\t100\t10.00000%\n")
+
+
+def cutadapt(args: List[str]) -> None:
+    flags = parse_flags(args)
+    write_fastq(flags["-o"])
+    write_fastq(flags["-p"])
+    sys.stdout.write("This is cutadapt (stub)\n")
+
+
+def star(args: List[str]) -> None:
+    flags = parse_flags(args)
+    prefix = flags["--outFileNamePrefix"]
+    touch(f"{prefix}Aligned.sortedByCoord.out.bam")
+    touch(f"{prefix}Log.final.out", "                          Uniquely mapped reads % |\t90.00%\n")
+    n_genes = int(os.environ.get(GENES_VARIABLE, 100))
+    rows = ["N_unmapped\t0\t0\t0", "N_multimapping\t0\t0\t0", "N_noFeature\t0\t0\t0", "N_ambiguous\t0\t0\t0"]
+    rows += [f"GENE{i}\t{random.randint(0, 1000)}\t0\t0" for i in range(n_genes)]
+    touch(f"{prefix}ReadsPerGene.out.tab", "\n".join(rows) + "\n")
+
+
+def stub_transcripts() -> List[str]:
+    # two versioned transcripts per stub gene, matching generators.generate_tx2gene
+    n_genes = int(os.environ.get(GENES_VARIABLE, 100))
+    return [f"TX{i}.1" for i in range(2 * n_genes)]
+
+
+def salmon(args: List[str]) -> None:
+    flags = parse_flags(args)
+    if args[0] == "index":
+        os.makedirs(flags["-i"], exist_ok=True)
+    elif args[0] == "quant":
+        os.makedirs(flags["-o"], exist_ok=True)
+        rows = [f"{name}\t1000\t800\t0\t{random.uniform(0, 500):.3f}" for name in stub_transcripts()]
+        touch(os.path.join(flags["-o"], "quant.sf"), "Name\tLength\tEffectiveLength\tTPM\tNumReads\n" + "\n".join(rows) + "\n")
+
+
+def kallisto(args: List[str]) -> None:
+    flags = parse_flags(args)
+    if args[0] == "index":
+        touch(flags["-i"])
+    elif args[0] == "quant":
+        os.makedirs(flags["-o"], exist_ok=True)
+        rows = [f"{name}\t1000\t800\t{random.uniform(0, 500):.3f}\t0" for name in stub_transcripts()]
+        touch(os.path.join(flags["-o"], "abundance.tsv"), "target_id\tlength\teff_length\test_counts\ttpm\n" + "\n".join(rows) + "\n")
+
+
+def samtools(args: List[str]) -> None:
+    if args[0] == "index":
+        touch(args[2] if len(args) > 2 else f"{args[1]}.bai")
+    elif args[0] == "idxstats":
+        sys.stdout.write("chr1\t248956422\t100\t0\n*\t0\t0\t0\n")
+
+
+def java(args: List[str]) -> None:
+    # only picard MarkDuplicates is called through java
+    key_values = parse_key_values(args)
+    touch(key_values["O"])
+    touch(key_values["M"], "## METRICS CLASS\tpicard.sam.DuplicationMetrics\n")
+
+
+def rseqc_report(args: List[str]) -> None:
+    sys.stdout.write("This is PairEnd Data\nFraction of reads explained by \"1++,1--,2+-,2-+\": 0.5\n")
+
+
+def gene_body_coverage(args: List[str]) -> None:
+    prefix = parse_flags(args)["-o"]
+    touch(f"{prefix}.geneBodyCoverage.txt", "Percentile\t" + "\t".join(str(i) for i in range(1, 101)) + "\n")
+
+
+def multiqc(args: List[str]) -> None:
+    output_directory = parse_flags(args)["-o"]
+    os.makedirs(output_directory, exist_ok=True)
+    touch(os.path.join(output_directory, "multiqc_report.html"))
+
+
+STUBS = {
+    "fastqc": fastqc,
+    "bbmerge.sh": bbmerge,
+    "bbduk.sh": bbduk,
+    "cutadapt": cutadapt,
+    "STAR": star,
+    "samtools": samtools,
+    "java": java,
+    "infer_experiment.py": rseqc_report,
+    "read_distribution.py": rseqc_report,
+    "geneBody_coverage.py": gene_body_coverage,
+    "multiqc": multiqc,
+    "salmon": salmon,
+    "kallisto": kallisto,
+}
+
+
+def main():
+    # simulate the tool runtime before writing its outputs
+    time.sleep(float(os.environ.get(LATENCY_VARIABLE, 0)))
+    STUBS[os.path.basename(sys.argv[0])](sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from constants import *
+from normalization import iterate_chunks
+
+# create a logger object writing to the given file
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def sample_metrics(filename: str, chunk_size: int, mito_prefix: str) -> pd.DataFrame:
+    # library size, detected genes and mitochondrial fraction of every sample in one streaming pass
+    library_sizes, detected, mito = None, None, None
+    for chunk in iterate_chunks(filename=filename, chunk_size=chunk_size):
+        counts = chunk.to_numpy(dtype=np.float64)
+        if library_sizes is None:
+            samples = chunk.columns
+            library_sizes, detected, mito = [np.zeros(counts.shape[1]) for _ in range(3)]
+        library_sizes += counts.sum(axis=0)
+        detected += (counts > 0).sum(axis=0)
+        is_mito = chunk.index.astype(str).str.startswith(mito_prefix)
+        mito += counts[is_mito].sum(axis=0)
+    if library_sizes is None:
+        raise ValueError(f"There are no genes in {filename}")
+    return pd.DataFrame(
+        {
+            "library_size": library_sizes,
+            "detected_genes": detected,
+            "mito_fraction": mito / np.maximum(library_sizes, 1),
+        },
+        index=samples,
+    )
+
+
+def top_variable_genes(
+    filename: str, chunk_size: int, library_sizes: np.ndarray, n_top_genes: int
+) -> np.ndarray:
+    # log1p CPM of the most variable genes, keeping only the current top genes between chunks
+    top, top_variances = None, None
+    for chunk in iterate_chunks(filename=filename, chunk_size=chunk_size):
+        log_cpm = np.log1p(chunk.to_numpy(dtype=np.float64) / library_sizes * 1e6).astype(np.float32)
+        variances = log_cpm.var(axis=1)
+        if top is not None:
+            log_cpm = np.vstack([top, log_cpm])
+            variances = np.concatenate([top_variances, variances])
+        if len(variances) > n_top_genes:
+            keep = np.argpartition(variances, -n_top_genes)[-n_top_genes:]
+            log_cpm, variances = log_cpm[keep], variances[keep]
+        top, top_variances = log_cpm, variances
+    return top
+
+
+def correlation_block(standardized: np.ndarray, start: int, stop: int) -> Tuple[int, np.ndarray]:
+    # Pearson correlations of a block of samples against every sample
+    return start, standardized[:, start:stop].T @ standardized
+
+
+def blocked_correlation(
+    expression: np.ndarray, block_size: int, n_cores: int, keep_matrix: bool
+) -> Tuple[np.ndarray, np.ndarray]:
+    # median correlation of each sample to the others, and the full matrix when small enough to report
+    centered = expression - expression.mean(axis=0)
+    norms = np.linalg.norm(centered, axis=0)
+    standardized = centered / np.where(norms > 0, norms, 1)
+    n_samples = expression.shape[1]
+    median_correlations = np.zeros(n_samples, dtype=np.float32)
+    matrix = np.zeros((n_samples, n_samples), dtype=np.float32) if keep_matrix else None
+    # matrix products release the GIL so threads share the standardized matrix without copies
+    with ThreadPoolExecutor(max_workers=n_cores) as executor:
+        futures = [
+            executor.submit(correlation_block, standardized, start, min(start + block_size, n_samples))
+            for start in range(0, n_samples, block_size)
+        ]
+        for future in futures:
+            start, block = future.result()
+            stop = start + block.shape[0]
+            if keep_matrix:
+                matrix[start:stop] = block
+            # exclude each sample's correlation with itself
+            block[np.arange(block.shape[0]), np.arange(start, stop)] = np.nan
+            median_correlations[start:stop] = np.nanmedian(block, axis=1)
+    return median_correlations, matrix
+
+
+def randomized_pca(
+    expression: np.ndarray, n_components: int, n_oversamples: int = 10, n_iterations: int = 4, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    # truncated PCA of the samples by randomized range finding with power iterations (Halko et al. 2011)
+    samples = (expression - expression.mean(axis=1, keepdims=True)).T
+    n_components = min(n_components, *samples.shape)
+    rng = np.random.default_rng(seed)
+    sketch = samples @ rng.standard_normal((samples.shape[1], n_components + n_oversamples)).astype(samples.dtype)
+    basis, _ = np.linalg.qr(sketch)
+    for _ in range(n_iterations):
+        basis, _ = np.linalg.qr(samples.T @ basis)
+        basis, _ = np.linalg.qr(samples @ basis)
+    u, s, _ = np.linalg.svd(basis.T @ samples, full_matrices=False)
+    scores = (basis @ u[:, :n_components]) * s[:n_components]
+    total_variance = (samples.astype(np.float64) ** 2).sum()
+    explained = s[:n_components] ** 2 / max(total_variance, np.finfo(float).tiny)
+    return scores, explained
+
+
+def robust_z(values: np.ndarray) -> np.ndarray:
+    # distance from the median in units of the scaled median absolute deviation
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    return (values - median) / (mad if mad > 0 else 1)
+
+
+def flag_outliers(metrics: pd.DataFrame, columns: List[str], threshold: float) -> pd.Series:
+    # list the metrics on which each sample is a robust outlier
+    flags = pd.DataFrame(
+        {column: np.abs(robust_z(metrics[column].to_numpy(dtype=np.float64))) > threshold for column in columns},
+        index=metrics.index,
+    )
+    return flags.apply(lambda row: ",".join(row.index[row]) if row.any() else "none", axis=1)
+
+
+def write_mqc(filename: str, headers: Dict[str, str], df: pd.DataFrame) -> None:
+    # MultiQC custom content: commented YAML header lines followed by a tab separated table
+    partial = os.path.join(os.path.dirname(filename), PARTIAL_PREFIX + os.path.basename(filename))
+    with open(partial, "w") as f:
+        for key, value in headers.items():
+            f.write(f"# {key}: {value}\n")
+        df.to_csv(f, sep="\t", index_label="Sample", float_format="%.6g")
+    os.replace(partial, filename)
+
+
+def run_cohort_qc(
+    counts_filename: str,
+    output_directory: str,
+    qc_reports_directory: str,
+    mito_prefix: str,
+    n_top_genes: int,
+    n_components: int,
+    outlier_threshold: float,
+    chunk_size: int,
+    n_cores: int,
+) -> None:
+    # per-sample metrics from the raw counts
+    logger.info(f"Running cohort QC on {counts_filename}")
+    metrics = sample_metrics(filename=counts_filename, chunk_size=chunk_size, mito_prefix=mito_prefix)
+    metrics["log10_library_size"] = np.log10(np.maximum(metrics["library_size"], 1))
+    expression = top_variable_genes(
+        filename=counts_filename,
+        chunk_size=chunk_size,
+        library_sizes=np.maximum(metrics["library_size"].to_numpy(), 1),
+        n_top_genes=n_top_genes,
+    )
+    logger.info(f"Cohort QC on N={expression.shape[1]} samples over N={expression.shape[0]} variable genes")
+    # sample to sample correlation in blocks of samples
+    keep_matrix = expression.shape[1] <= COHORT_HEATMAP_MAX_SAMPLES
+    metrics["median_correlation"], matrix = blocked_correlation(
+        expression=expression,
+        block_size=COHORT_CORRELATION_BLOCK_SIZE,
+        n_cores=n_cores,
+        keep_matrix=keep_matrix,
+    )
+    # principal components of the samples
+    scores, explained = randomized_pca(expression=expression, n_components=n_components)
+    pcs = pd.DataFrame(
+        scores, index=metrics.index, columns=[f"PC{i + 1}" for i in range(scores.shape[1])]
+    )
+    metrics["PC1"] = pcs["PC1"]
+    metrics["PC2"] = pcs["PC2"] if pcs.shape[1] > 1 else 0.0
+    metrics["outlier"] = flag_outliers(
+        metrics=metrics,
+        columns=["log10_library_size", "detected_genes", "mito_fraction", "median_correlation", "PC1", "PC2"],
+        threshold=outlier_threshold,
+    )
+    logger.info(f"Flagged N={(metrics['outlier'] != 'none').sum()} outlier samples")
+
+    # full tables next to the count matrix
+    os.makedirs(output_directory, exist_ok=True)
+    metrics.to_csv(os.path.join(output_directory, "cohort_qc.tsv"), sep="\t", index_label="Sample")
+    pcs.loc["variance_explained"] = explained
+    pcs.to_csv(os.path.join(output_directory, "cohort_pca.tsv"), sep="\t", index_label="Sample")
+
+    # compact table and plots picked up by MultiQC
+    os.makedirs(qc_reports_directory, exist_ok=True)
+    write_mqc(
+        filename=os.path.join(qc_reports_directory, "cohort_qc_mqc.tsv"),
+        headers={
+            "id": "'cohort_qc'",
+            "section_name": "'Cohort QC'",
+            "description": f"'Per-sample metrics from the count matrix, outliers exceed a robust z-score of {outlier_threshold}'",
+            "plot_type": "'table'",
+        },
+        df=metrics.drop(columns=["log10_library_size"]),
+    )
+    write_mqc(
+        filename=os.path.join(qc_reports_directory, "cohort_pca_mqc.tsv"),
+        headers={
+            "id": "'cohort_pca'",
+            "section_name": "'Cohort PCA'",
+            "description": f"'Randomized PCA of log1p CPM over the {expression.shape[0]} most variable genes'",
+            "plot_type": "'scatter'",
+            "pconfig": f"{{xlab: 'PC1 ({100 * explained[0]:.1f}%)', ylab: 'PC2 ({100 * explained[min(1, len(explained) - 1)]:.1f}%)'}}",
+        },
+        df=metrics[["PC1", "PC2"]].rename(columns={"PC1": "x", "PC2": "y"}),
+    )
+    if keep_matrix:
+        write_mqc(
+            filename=os.path.join(qc_reports_directory, "cohort_correlation_mqc.tsv"),
+            headers={
+                "id": "'cohort_correlation'",
+                "section_name": "'Cohort correlation'",
+                "description": "'Pearson correlation of log1p CPM over the most variable genes'",
+                "plot_type": "'heatmap'",
+            },
+            df=pd.DataFrame(matrix, index=metrics.index, columns=metrics.index),
+        )
+    logger.info(f"Cohort QC written to {output_directory} and {qc_reports_directory}")
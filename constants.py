@@ -1,31 +1,129 @@
 # pipeline steps, in order, from raw data to raw counts
 PIPELINE_STEPS = [
+    "select_shard",
+    "merge_lanes",
+    "validate_inputs",
     "qc_raw_fastq",
     "detect_adapters",
     "quantify_adapters",
     "trim_fastq",
     "qc_trimmed_fastq",
+    "quantify_transcripts",
     "map_fastq_to_bam",
     "index_bam",
     "dedup_bam",
     "index_dedup_bam",
     "qc_nondedup_bam",
     "aggregate_counts",
+    "qc_cohort",
     "aggregate_qc_reports",
 ]
+# steps preparing raw_fastq_directory, run before any start step that still reads FASTQs
+SETUP_STEPS = ["select_shard", "merge_lanes", "validate_inputs"]
+# steps reading the raw (or lane merged) FASTQs
+RAW_FASTQ_STEPS = ["qc_raw_fastq", "detect_adapters", "trim_fastq"]
+# steps reading the raw FASTQs in place of the trimmed ones when trimming is skipped
+UNTRIMMED_FASTQ_STEPS = ["quantify_transcripts", "map_fastq_to_bam"]
 # quality control directories
 RUN_DIRECTORIES = [
+    "shard_fastq_directory",
+    "merged_fastq_directory",
+    "validated_fastq_directory",
     "raw_fastqc_directory",
     "trimmed_fastq_directory",
     "trimmed_fastqc_directory",
     "adapter_output_directory",
     "cutadapt_output_directory",
     "mapped_bam_directory",
+    "pseudo_output_directory",
     "dedup_stats_directory",
     "bam_qc_reports_directory",
     "counts_output_directory",
     "qc_reports_directory",
     "multiqc_output_directory",
 ]
+# per-sample working directories that are placed on local scratch when configured
+SCRATCH_DIRECTORIES = [
+    "trimmed_fastq_directory",
+    "mapped_bam_directory",
+]
+# intermediates as (directory key, suffix key, consuming steps), deleted once every consumer has finished
+INTERMEDIATES = {
+    "trimmed_fastq": ("trimmed_fastq_directory", "trimmed_suffix", ["qc_trimmed_fastq", "quantify_transcripts", "map_fastq_to_bam"]),
+    "nondedup_bam": ("mapped_bam_directory", "bam_nondedup_suffix", ["index_bam", "dedup_bam", "qc_nondedup_bam"]),
+}
+# final outputs as (directory key, suffix key) copied back from scratch after the step producing them
+FINAL_OUTPUTS = {
+    "map_fastq_to_bam": [("mapped_bam_directory", "count_suffix"), ("mapped_bam_directory", "star_log_suffix")],
+    "dedup_bam": [("mapped_bam_directory", "deduped_suffix")],
+    "index_dedup_bam": [("mapped_bam_directory", "deduped_suffix")],
+}
+# resource models of per-sample steps, memory in GB is base + per input GB up to a maximum
+# threads of 0 split n_cores across the concurrent jobs, inputs are raw "fastq", "trimmed" fastq or "bam"
+RESOURCE_MODELS = {
+    "validate_inputs": {"input": "fastq", "memory_base_gb": 1, "memory_per_input_gb": 0, "memory_max_gb": 1, "seconds_per_input_gb": 30, "threads": 1},
+    "qc_raw_fastq": {"input": "fastq", "memory_base_gb": 1, "memory_per_input_gb": 0, "memory_max_gb": 1, "seconds_per_input_gb": 60, "threads": 1},
+    "detect_adapters": {"input": "fastq", "memory_base_gb": 1, "memory_per_input_gb": 1, "memory_max_gb": 16, "seconds_per_input_gb": 120, "threads": 1},
+    "trim_fastq": {"input": "fastq", "memory_base_gb": 1, "memory_per_input_gb": 0, "memory_max_gb": 1, "seconds_per_input_gb": 180, "threads": 1},
+    "qc_trimmed_fastq": {"input": "trimmed", "memory_base_gb": 1, "memory_per_input_gb": 0, "memory_max_gb": 1, "seconds_per_input_gb": 60, "threads": 1},
+    "quantify_transcripts": {"input": "trimmed", "memory_base_gb": 8, "memory_per_input_gb": 0, "memory_max_gb": 8, "seconds_per_input_gb": 60, "threads": 0},
+    "map_fastq_to_bam": {"input": "trimmed", "memory_base_gb": 32, "memory_per_input_gb": 2, "memory_max_gb": 96, "seconds_per_input_gb": 600, "threads": 0},
+    "index_bam": {"input": "bam", "memory_base_gb": 1, "memory_per_input_gb": 0, "memory_max_gb": 1, "seconds_per_input_gb": 30, "threads": 1},
+    "dedup_bam": {"input": "bam", "memory_base_gb": 2, "memory_per_input_gb": 2, "memory_max_gb": 64, "seconds_per_input_gb": 300, "threads": 1},
+    "index_dedup_bam": {"input": "bam", "memory_base_gb": 1, "memory_per_input_gb": 0, "memory_max_gb": 1, "seconds_per_input_gb": 30, "threads": 1},
+    "qc_nondedup_bam": {"input": "bam", "memory_base_gb": 2, "memory_per_input_gb": 0, "memory_max_gb": 2, "seconds_per_input_gb": 900, "threads": 1},
+}
+# approximate size of a sorted BAM relative to its gzipped paired FASTQs
+BAM_PER_FASTQ_BYTES = 0.8
+# prefix of outputs still being written, hidden from the suffix globs until renamed on success
+PARTIAL_PREFIX = ".partial."
+# outputs STAR writes after the --outFileNamePrefix of each sample
+STAR_OUTPUT_SUFFIXES = [
+    "Aligned.sortedByCoord.out.bam",
+    "ReadsPerGene.out.tab",
+    "SJ.out.tab",
+    "Log.final.out",
+    "Log.progress.out",
+    "Log.out",
+]
+# journal unit of the gene body coverage computed across every sample at once
+GENE_BODY_UNIT = "gene_body_coverage"
+# memo of reference checksums by path, size and modification time in the reference cache
+REFERENCE_CHECKSUMS_FILENAME = "checksums.json"
+# normalized count matrices aggregate_counts can write next to the raw matrix
+COUNT_NORMALIZATIONS = ["cpm", "tpm", "log1p_cpm", "size_factors"]
+# histogram of the log ratios to the gene geometric means used for the median-of-ratios size factors,
+# ratios outside the range are clipped into the edge bins so only the median has to fall inside it
+SIZE_FACTOR_BINS = 2048
+SIZE_FACTOR_LOG_RANGE = (-4.0, 4.0)
+# cohort QC correlates samples in blocks of this many and only reports the heatmap of small cohorts
+COHORT_CORRELATION_BLOCK_SIZE = 512
+COHORT_HEATMAP_MAX_SAMPLES = 500
+# steps producing or reading BAMs, replaced by quantify_transcripts in the pseudo quantification mode
+BAM_STEPS = ["map_fastq_to_bam", "index_bam", "dedup_bam", "index_dedup_bam", "qc_nondedup_bam"]
+# per-sample transcript table written by each pseudo-aligner as (filename, transcript column, count column)
+PSEUDO_QUANT_FILES = {
+    "salmon": ("quant.sf", "Name", "NumReads"),
+    "kallisto": ("abundance.tsv", "target_id", "est_counts"),
+}
+# uniformly expressed human genes (Eisenberg and Levanon 2013 and common qPCR references) kept in the
+# generated downsampled BED for gene body coverage and strand inference, matched case-insensitively
+HOUSEKEEPING_GENES = [
+    "ACTB", "ACTG1", "ALDOA", "ARF1", "ARPC2", "ATP5F1A", "ATP5F1B", "B2M", "C1orf43", "CALM2",
+    "CANX", "CAPZB", "CFL1", "CHMP2A", "COX4I1", "CTNNB1", "CYC1", "DDX5", "EEF1A1", "EEF2",
+    "EIF4A2", "EIF4G2", "EMC7", "ENO1", "GABARAP", "GAPDH", "GDI2", "GPI", "GUSB", "HMBS",
+    "HNRNPA1", "HNRNPK", "HPRT1", "HSP90AB1", "LAMP1", "LDHA", "MRPL19", "NDUFA4", "NONO", "PARK7",
+    "PFN1", "PGK1", "PKM", "POLR2A", "PPIA", "PRDX1", "PSMA1", "PSMB1", "PSMB2", "PSMB4",
+    "PSMD4", "PUM1", "RAB1A", "RAB7A", "RACK1", "REEP5", "RPL13A", "RPL19", "RPL32", "RPLP0",
+    "RPS13", "RPS18", "RPS27A", "SDHA", "SET", "SF3B1", "SNRPD3", "SOD1", "SRP14", "SRSF3",
+    "TARDBP", "TBP", "TFRC", "TMBIM6", "TOP1", "TPI1", "TUBA1B", "TUBB", "TXN", "UBB",
+    "UBC", "UQCRH", "VCP", "VPS29", "YWHAB", "YWHAZ",
+]
+# read1 and read2 adapters picked by quantify_adapters, written to adapter_output_directory
+DOMINANT_ADAPTERS_FILENAME = "dominant_adapters.tsv"
+# adapters each shard trimmed with, written next to the cohort-wide ones by --merge_shards
+SHARD_ADAPTERS_FILENAME = "shard_adapters.tsv"
+# compressed bytes read at a time when validating FASTQs
+VALIDATION_CHUNK_BYTES = 4 * 1024 ** 2
 # location of the status file
 STATUS_FILE = "status.log"
@@ -8,17 +8,22 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // --- Define Pipeline Modules ---
     const modules = [
+        "select_shard",
+        "merge_lanes",
+        "validate_inputs",
         "qc_raw_fastq",
         "detect_adapters",
         "quantify_adapters",
         "trim_fastq",
         "qc_trimmed_fastq",
+        "quantify_transcripts",
         "map_fastq_to_bam",
         "index_bam",
         "dedup_bam",
         "index_dedup_bam",
         "qc_nondedup_bam",
         "aggregate_counts",
+        "qc_cohort",
         "aggregate_qc_reports",
     ];
 
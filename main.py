@@ -1,12 +1,30 @@
 import argparse
+import hashlib
 import os
+import re
+import shutil
 import subprocess
+import time
+import zlib
 from glob import glob
 import logging
 import yaml
 import pandas as pd
 from typing import Dict, List, Tuple
 from constants import *
+from planner import (
+    build_plan,
+    load_history,
+    measure_inputs,
+    plan_step,
+    record_history,
+    report_plan,
+    sample_name,
+)
+from cohort_qc import run_cohort_qc
+from normalization import normalize_count_matrix
+from validation import check_pairs, validate_fastqs, write_validation_report
+from references import prepare_references, write_gene_lengths, write_tx2gene
 
 # create a logger object writing to the given file
 logger = logging.getLogger(__name__)
@@ -45,12 +63,103 @@ def configure_config(configs: Dict) -> Dict:
     # build fastq suffixes for trimmed read1 and read2
     configs["r1_trimmed_fastq_suffix"] = configs["r1"] + configs["trimmed_suffix"]
     configs["r2_trimmed_fastq_suffix"] = configs["r2"] + configs["trimmed_suffix"]
+    configs.setdefault("star_log_suffix", "_Log.final.out")
+    # give every shard its own run directory below the cohort run directory
+    configs.setdefault("shard", None)
+    configs.setdefault("shard_fastq_directory", "data/shard_fastq")
+    if configs["shard"] is not None:
+        shard_index, n_shards = parse_shard(shard=configs["shard"])
+        configs["run_directory"] = os.path.join(
+            configs["run_directory"], f"shard_{shard_index}_of_{n_shards}"
+        )
+    # lanes are only merged when a merge mode is configured
+    configs.setdefault("lane_merge_mode", None)
+    configs.setdefault("lane_pattern", "_L[0-9]{3}")
+    configs.setdefault("merged_fastq_directory", "data/merged_fastq")
+    # size tool memory and threads from the inputs and earlier timings when requested
+    configs.setdefault("auto_resources", False)
+    configs.setdefault("timing_history_filename", "pipeline_timings.jsonl")
+    configs["resources"] = {}
+    # record completed (step, sample) units so interrupted runs can resume
+    configs.setdefault("journal_filename", "pipeline_journal")
+    # validate the inputs up front, caching results per file fingerprint
+    configs.setdefault("invalid_input_action", "fail")
+    configs.setdefault("validated_fastq_directory", "data/validated_fastq")
+    configs.setdefault("validation_cache_filename", "input_validation_cache.json")
+    # quantify genes from STAR alignments or, skipping every BAM step, a pseudo-aligner
+    configs.setdefault("quantification_mode", "star")
+    configs.setdefault("pseudo_aligner", "salmon")
+    configs.setdefault("transcriptome_fasta", None)
+    configs.setdefault("transcriptome_index", None)
+    configs.setdefault("tx2gene_filename", None)
+    configs.setdefault("pseudo_output_directory", "data/pseudo_quant")
+    configs.setdefault("pseudo_count_suffix", "_gene_counts.tsv")
+    # derive reference assets once per checksum when a reference cache is configured
+    configs.setdefault("reference_cache_directory", None)
+    configs.setdefault("reference_fasta", None)
+    configs.setdefault("reference_gtf", None)
+    configs.setdefault("bam_qc_reference_downsampled", None)
+    configs.setdefault("housekeeping_genes_filename", None)
+    configs.setdefault("reference_downsample_n_genes", 2000)
+    # normalized matrices written next to the raw counts
+    configs.setdefault("count_normalizations", [])
+    configs.setdefault("normalization_chunk_size", 5000)
+    configs.setdefault("gene_lengths_filename", None)
+    # cohort QC from the count matrix
+    configs.setdefault("mito_gene_prefix", "MT-")
+    configs.setdefault("cohort_qc_top_genes", 2000)
+    configs.setdefault("cohort_qc_components", 10)
+    configs.setdefault("cohort_outlier_threshold", 3.5)
+    # delete intermediates after their last consumer unless the configuration keeps them
+    configs.setdefault("keep_intermediates", False)
+    # stage per-sample work on local scratch, unique to this run directory
+    configs["final_directories"] = {}
+    if configs.get("scratch_directory"):
+        run_directory = os.path.abspath(configs["run_directory"])
+        run_hash = hashlib.sha1(run_directory.encode()).hexdigest()[:8]
+        configs["scratch_run_directory"] = os.path.join(
+            configs["scratch_directory"], f"{os.path.basename(run_directory)}_{run_hash}"
+        )
     # create full paths to each directory
     for key in RUN_DIRECTORIES:
-        configs[key] = os.path.join(configs["run_directory"], configs[key])
+        if configs.get("scratch_directory") and key in SCRATCH_DIRECTORIES:
+            configs["final_directories"][key] = os.path.join(configs["run_directory"], configs[key])
+            configs[key] = os.path.join(configs["scratch_run_directory"], configs[key])
+        else:
+            configs[key] = os.path.join(configs["run_directory"], configs[key])
+    configs["timing_history_filename"] = os.path.join(
+        configs["run_directory"], configs["timing_history_filename"]
+    )
+    configs["journal_filename"] = os.path.join(
+        configs["run_directory"], configs["journal_filename"]
+    )
+    configs["validation_cache_filename"] = os.path.join(
+        configs["run_directory"], configs["validation_cache_filename"]
+    )
+    # read the linked shard samples in place of the raw FASTQs from here on
+    if configs["shard"] is not None:
+        configs["shard_source_directory"] = configs["raw_fastq_directory"]
+        configs["raw_fastq_directory"] = configs["shard_fastq_directory"]
+    # read the concatenated lanes in place of the raw FASTQs from here on
+    if configs["lane_merge_mode"] == "concatenate":
+        configs["lane_fastq_directory"] = configs["raw_fastq_directory"]
+        configs["raw_fastq_directory"] = configs["merged_fastq_directory"]
     return configs
 
 
+def parse_shard(shard: str) -> Tuple[int, int]:
+    # parse a shard given as i/N with i counting from one
+    shard_index, n_shards = [int(el) for el in shard.split("/")]
+    if not 1 <= shard_index <= n_shards:
+        raise ValueError(f"Shard {shard} must be given as i/N with 1 <= i <= N")
+    return shard_index, n_shards
+
+
+def assign_shard(sample: str, n_shards: int) -> int:
+    # stable hash of the sample name so every machine agrees on the partition
+    return zlib.crc32(sample.encode()) % n_shards + 1
+
+
 def identify_start_step(configs: Dict, pipeline_steps: List[str]) -> List[str]:
     # retrieve the requested step to start the pipeline from
     logger.info("Identifying starting step for the pipeline")
@@ -59,9 +168,66 @@ def identify_start_step(configs: Dict, pipeline_steps: List[str]) -> List[str]:
     start_step_index = pipeline_steps.index(pipeline_start_step)
     # subset the pipeline steps based on the requested starting step
     relevant_steps = pipeline_steps[start_step_index:]
+    # shard selection, lane merging and validation decide which raw FASTQs later steps read
+    raw_fastq_steps = RAW_FASTQ_STEPS + (UNTRIMMED_FASTQ_STEPS if configs["skip_trimming"] else [])
+    if any(step in raw_fastq_steps for step in relevant_steps):
+        setup_steps = [step for step in SETUP_STEPS if pipeline_steps.index(step) < start_step_index]
+        if len(setup_steps) > 0:
+            logger.info(f"Running setup steps {setup_steps} before {pipeline_start_step}")
+        relevant_steps = setup_steps + relevant_steps
     return relevant_steps
 
 
+def count_consumers(pipeline_steps: List[str]) -> Dict[str, int]:
+    # count how many of the steps about to run still need each intermediate
+    consumers = {}
+    for name, (_, _, steps) in INTERMEDIATES.items():
+        consumers[name] = len([step for step in pipeline_steps if step in steps])
+    return consumers
+
+
+def release_intermediates(pipeline_step: str, configs: Dict, consumers: Dict[str, int]) -> None:
+    # decrement each intermediate this step consumed and delete it after its last consumer
+    for name, (directory_key, suffix_key, steps) in INTERMEDIATES.items():
+        if pipeline_step not in steps or consumers[name] == 0:
+            continue
+        consumers[name] -= 1
+        if consumers[name] > 0 or configs["keep_intermediates"]:
+            continue
+        filenames = glob(os.path.join(configs[directory_key], f"*{configs[suffix_key]}*"))
+        logger.info(
+            f"Deleting {name} intermediates N={len(filenames)} files from {configs[directory_key]}"
+        )
+        for filename in filenames:
+            os.remove(filename)
+
+
+def stage_final_outputs(pipeline_step: str, configs: Dict) -> None:
+    # copy the declared final outputs of this step from scratch back to the run directory
+    for directory_key, suffix_key in FINAL_OUTPUTS.get(pipeline_step, []):
+        if directory_key not in configs["final_directories"]:
+            continue
+        final_directory = configs["final_directories"][directory_key]
+        os.makedirs(final_directory, exist_ok=True)
+        filenames = glob(os.path.join(configs[directory_key], f"*{configs[suffix_key]}*"))
+        logger.info(f"Copying N={len(filenames)} final outputs to {final_directory}")
+        for filename in filenames:
+            # skip outputs already copied back by an earlier step
+            final_filename = os.path.join(final_directory, os.path.basename(filename))
+            if os.path.exists(final_filename) and os.path.getsize(final_filename) == os.path.getsize(filename):
+                continue
+            shutil.copy2(filename, final_filename)
+
+
+def job_resource(resources: Dict, sample: str, key: str, default):
+    # planned resource of a job, or the default when nothing was planned
+    if not resources:
+        return default
+    if sample not in resources:
+        logger.info(f"No planned resources for {sample}, using the default {key} of {default}")
+    return resources.get(sample, {}).get(key, default)
+
+
 def run(command: str) -> subprocess.Popen:
     # run a command in the shell and return the process
     logger.info(f"Running `{command}`...")
@@ -69,7 +235,251 @@ def run(command: str) -> subprocess.Popen:
     return process
 
 
-def run_fastqc(fastq_suffix: str, fastq_directory: str, output_directory: str) -> None:
+def partial_filename(filename: str) -> str:
+    # hidden name in the same directory that suffix globs skip until the output is complete
+    return os.path.join(os.path.dirname(filename), PARTIAL_PREFIX + os.path.basename(filename))
+
+
+def read_journal(filename: str, pipeline_step: str) -> set:
+    # units of a step completed by this or an interrupted earlier run whose outputs still exist
+    if filename is None or not os.path.exists(filename):
+        return set()
+    with open(filename, "r") as f:
+        # ignore a trailing record cut short by the interruption
+        records = [line.rstrip("\n").split("\t") for line in f if line.endswith("\n")]
+    records = [record for record in records if len(record) >= 2 and record[0] == pipeline_step]
+    # outputs on a lost scratch disk or deleted as intermediates have to be made again
+    completed = {record[1] for record in records if all(os.path.lexists(el) for el in record[2:])}
+    n_missing = len({record[1] for record in records} - completed)
+    if n_missing > 0:
+        logger.info(f"Recomputing N={n_missing} journaled {pipeline_step} units whose outputs are missing")
+    return completed
+
+
+def record_journal(filename: str, pipeline_step: str, unit: str, outputs: List[str] = None) -> None:
+    # append a completed unit with its outputs and force it to disk before moving on
+    with open(filename, "a") as f:
+        f.write("\t".join([pipeline_step, unit] + (outputs or [])) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def reset_journal(filename: str, pipeline_steps: List[str]) -> None:
+    # forget the units of the steps about to run again so they are recomputed
+    if not os.path.exists(filename):
+        return
+    with open(filename, "r") as f:
+        lines = [line for line in f if line.split("\t")[0] not in pipeline_steps]
+    with open(partial_filename(filename), "w") as f:
+        f.writelines(lines)
+    os.replace(partial_filename(filename), filename)
+
+
+def commit_outputs(outputs: List[Tuple[str, str]]) -> List[str]:
+    # rename each temporary output onto its final name, moving the contents of staging directories
+    committed = []
+    for partial, final in outputs:
+        if os.path.isdir(partial):
+            os.makedirs(final, exist_ok=True)
+            for name in os.listdir(partial):
+                os.replace(os.path.join(partial, name), os.path.join(final, name))
+                committed.append(os.path.join(final, name))
+            os.rmdir(partial)
+        elif os.path.lexists(partial):
+            os.replace(partial, final)
+            committed.append(final)
+    return committed
+
+
+def wait_for_jobs(
+    jobs: List[Tuple[str, List[subprocess.Popen], List[Tuple[str, str]]]],
+    journal: str = None,
+    pipeline_step: str = None,
+) -> None:
+    # wait for every process of each unit, publish its outputs and journal it only if all succeeded
+    failed = []
+    for unit, processes, outputs in jobs:
+        return_codes = [process.wait() for process in processes]
+        if any(return_code != 0 for return_code in return_codes):
+            failed.append(unit)
+            continue
+        committed = commit_outputs(outputs=outputs)
+        if journal is not None:
+            record_journal(filename=journal, pipeline_step=pipeline_step, unit=unit, outputs=committed)
+    if len(failed) > 0:
+        raise ValueError(f"N={len(failed)} jobs failed: {', '.join(failed)}")
+
+
+def link_fastqs(filenames: List[str], output_directory: str) -> None:
+    # replace any previous links so the directory only holds the given FASTQs
+    os.makedirs(output_directory, exist_ok=True)
+    for filename in glob(os.path.join(output_directory, "*")):
+        if os.path.islink(filename):
+            os.remove(filename)
+    for filename in filenames:
+        os.symlink(
+            os.path.abspath(filename),
+            os.path.join(output_directory, os.path.basename(filename)),
+        )
+
+
+def select_shard(
+    r1_fastq_suffix: str,
+    r2_fastq_suffix: str,
+    fastq_directory: str,
+    shard: str,
+    lane_pattern: str,
+    output_directory: str,
+) -> None:
+    # identify all read1 fastq files in the input directory
+    r1_filenames = glob(os.path.join(fastq_directory, f"*{r1_fastq_suffix}"))
+    if len(r1_filenames) == 0:
+        raise ValueError(f"There are no FASTQs to shard in {fastq_directory}")
+    shard_index, n_shards = parse_shard(shard=shard)
+    filenames = []
+    for r1_filename in r1_filenames:
+        # assign all lanes of a sample to the same shard
+        sample = os.path.basename(r1_filename).split(r1_fastq_suffix)[0]
+        if lane_pattern is not None:
+            sample = re.sub(lane_pattern, "", sample, count=1)
+        if assign_shard(sample=sample, n_shards=n_shards) == shard_index:
+            r2_filename = r1_filename.replace(r1_fastq_suffix, r2_fastq_suffix)
+            filenames.extend([r1_filename, r2_filename])
+    logger.info(
+        f"Selected N={len(filenames) // 2} of N={len(r1_filenames)} read pairs for shard {shard}"
+    )
+    link_fastqs(filenames=filenames, output_directory=output_directory)
+
+
+def group_lanes(filenames: List[str], lane_pattern: str) -> Dict[str, List[str]]:
+    # group lane files by their basename with the lane token removed, lanes in sorted order
+    groups = {}
+    for filename in sorted(filenames):
+        name = re.sub(lane_pattern, "", os.path.basename(filename), count=1)
+        groups.setdefault(name, []).append(filename)
+    return groups
+
+
+def is_merged(merged: str, lanes: List[str]) -> bool:
+    # an earlier merge of the same lanes, kept so its modification time stays valid for the validation cache
+    if len(lanes) == 1:
+        return os.path.islink(merged) and os.readlink(merged) == os.path.abspath(lanes[0])
+    if not os.path.isfile(merged) or os.path.islink(merged):
+        return False
+    stat = os.stat(merged)
+    lane_stats = [os.stat(lane) for lane in lanes]
+    return stat.st_size == sum(el.st_size for el in lane_stats) and stat.st_mtime_ns >= max(
+        el.st_mtime_ns for el in lane_stats
+    )
+
+
+def merge_lanes(
+    r1_fastq_suffix: str,
+    r2_fastq_suffix: str,
+    fastq_directory: str,
+    lane_pattern: str,
+    output_directory: str,
+    journal: str = None,
+    pipeline_step: str = None,
+) -> None:
+    # identify all read1 fastq files in the input directory
+    os.makedirs(output_directory, exist_ok=True)
+    r1_filenames = glob(os.path.join(fastq_directory, f"*{r1_fastq_suffix}"))
+    if len(r1_filenames) == 0:
+        raise ValueError(f"There are no FASTQs to merge lanes from in {fastq_directory}")
+    r1_groups = group_lanes(filenames=r1_filenames, lane_pattern=lane_pattern)
+    logger.info(
+        f"Merging lanes in {fastq_directory} N={len(r1_filenames)} files into N={len(r1_groups)} samples"
+    )
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
+    for r1_name, r1_lanes in r1_groups.items():
+        if r1_name in completed:
+            continue
+        r2_name = r1_name.replace(r1_fastq_suffix, r2_fastq_suffix)
+        r2_lanes = [lane.replace(r1_fastq_suffix, r2_fastq_suffix) for lane in r1_lanes]
+        processes, outputs = [], []
+        for name, lanes in [(r1_name, r1_lanes), (r2_name, r2_lanes)]:
+            merged = os.path.join(output_directory, name)
+            if is_merged(merged=merged, lanes=lanes):
+                outputs.append((merged, merged))
+                continue
+            # link single lanes, otherwise concatenate the gzip members byte for byte
+            if len(lanes) == 1:
+                process = run(f"ln -sfn {os.path.abspath(lanes[0])} {partial_filename(merged)}")
+            else:
+                process = run(f"cat {' '.join(lanes)} > {partial_filename(merged)}")
+            processes.append(process)
+            outputs.append((partial_filename(merged), merged))
+        jobs.append((r1_name, processes, outputs))
+    # wait for all processes to finish
+    logger.info("Waiting for lane merging processes to finish...")
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
+    logger.info(
+        f"Lane merging completed successfully with outputs written to {output_directory}"
+    )
+
+
+def validate_inputs(
+    r1_fastq_suffix: str,
+    r2_fastq_suffix: str,
+    fastq_suffix: str,
+    fastq_directory: str,
+    cache_filename: str,
+    invalid_input_action: str,
+    n_cores: int,
+    report_directory: str,
+    output_directory: str,
+) -> str:
+    # identify all fastq files in the input directory
+    if invalid_input_action not in ["fail", "exclude"]:
+        raise ValueError(f"Unknown invalid_input_action {invalid_input_action}, choose from fail or exclude")
+    filenames = glob(os.path.join(fastq_directory, f"*{fastq_suffix}"))
+    if len(filenames) == 0:
+        raise ValueError(f"There are no FASTQs to validate in {fastq_directory}")
+    results = validate_fastqs(
+        filenames=filenames,
+        cache_filename=cache_filename,
+        n_cores=int(n_cores),
+        fail_fast=invalid_input_action == "fail",
+    )
+    problems = check_pairs(
+        results=results, r1_fastq_suffix=r1_fastq_suffix, r2_fastq_suffix=r2_fastq_suffix
+    )
+    write_validation_report(
+        results=results,
+        problems=problems,
+        report_filename=os.path.join(report_directory, "input_validation.tsv"),
+        checksum_filename=os.path.join(report_directory, "input_checksums.md5"),
+    )
+    if len(problems) == 0:
+        logger.info(f"All N={len(filenames)} FASTQs in {fastq_directory} are valid")
+        return None
+    for r1_filename, problem in sorted(problems.items()):
+        logger.info(f"Invalid read pair {r1_filename}: {problem}")
+    if invalid_input_action == "fail":
+        raise ValueError(f"N={len(problems)} invalid read pairs, e.g. {min(problems)}: {problems[min(problems)]}")
+    # link the valid pairs so later steps never see the excluded samples
+    r1_filenames = [
+        filename for filename in filenames if filename.endswith(r1_fastq_suffix) and filename not in problems
+    ]
+    if len(r1_filenames) == 0:
+        raise ValueError(f"Every read pair in {fastq_directory} is invalid")
+    logger.info(f"Excluding N={len(problems)} invalid read pairs, continuing with N={len(r1_filenames)}")
+    valid_filenames = []
+    for r1_filename in r1_filenames:
+        valid_filenames.extend([r1_filename, r1_filename.replace(r1_fastq_suffix, r2_fastq_suffix)])
+    link_fastqs(filenames=valid_filenames, output_directory=output_directory)
+    return output_directory
+
+
+def run_fastqc(
+    fastq_suffix: str,
+    fastq_directory: str,
+    output_directory: str,
+    journal: str = None,
+    pipeline_step: str = None,
+) -> None:
     # identify all fastq files in the input directory
     os.makedirs(output_directory, exist_ok=True)
     filenames = glob(os.path.join(fastq_directory, f"*{fastq_suffix}"))
@@ -77,13 +487,21 @@ def run_fastqc(fastq_suffix: str, fastq_directory: str, output_directory: str) -
         raise ValueError(f"There are no FASTQs to QC in {fastq_directory}")
     # run FastQC on each fastq file
     logger.info(f"Running FastQC on {fastq_directory} N={len(filenames)} files")
-    processes = [
-        run(f"fastqc {filename} -o {output_directory}") for filename in filenames
-    ]
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
+    for filename in filenames:
+        if os.path.basename(filename) in completed:
+            continue
+        # stage the reports of each file in its own directory as FastQC names them itself
+        staging_directory = partial_filename(
+            os.path.join(output_directory, f"{os.path.basename(filename)}_fastqc")
+        )
+        os.makedirs(staging_directory, exist_ok=True)
+        process = run(f"fastqc {filename} -o {staging_directory}")
+        jobs.append((os.path.basename(filename), [process], [(staging_directory, output_directory)]))
     # wait for all processes to finish
     logger.info("Waiting for FastQC processes to finish...")
-    for process in processes:
-        process.wait()
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
     logger.info(
         f"FastQC completed successfully with outputs written to {output_directory}"
     )
@@ -114,6 +532,10 @@ def detect_adapters(
     known_adapter_filename: str,
     known_adapter_suffix: str,
     output_directory: str,
+    lane_pattern: str = None,
+    resources: Dict = None,
+    journal: str = None,
+    pipeline_step: str = None,
 ):
     # identify all read1 fastq files in the input directory
     os.makedirs(output_directory, exist_ok=True)
@@ -123,8 +545,11 @@ def detect_adapters(
             f"There are no FASTQs to detect adapters from in {fastq_directory}"
         )
     logger.info(f"Detecting adapters for {fastq_directory} N={len(r1_filenames)} files")
-    processes = []
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
     for r1_filename in r1_filenames:
+        if os.path.basename(r1_filename) in completed:
+            continue
         # identify the corresponding read2 filename
         r2_filename = r1_filename.replace(r1_fastq_suffix, r2_fastq_suffix)
         # create the output filename for adapters
@@ -132,11 +557,20 @@ def detect_adapters(
             output_directory,
             os.path.basename(r1_filename).replace(r1_fastq_suffix, adapter_suffix),
         )
+        # lanes are planned together under their sample name
+        r1_name = os.path.basename(r1_filename)
+        if lane_pattern is not None:
+            r1_name = re.sub(lane_pattern, "", r1_name, count=1)
+        memory = job_resource(
+            resources=resources,
+            sample=sample_name(filename=r1_name, suffix=r1_fastq_suffix),
+            key="memory_gb",
+            default=4,
+        )
         # auto-detect adapters using bbmerge.sh
-        process = run(
-            f"bbmerge.sh -Xmx4g in1={r1_filename} in2={r2_filename} outa={adapter_filename}"
+        bbmerge_process = run(
+            f"bbmerge.sh -Xmx{memory}g in1={r1_filename} in2={r2_filename} outa={partial_filename(adapter_filename)}"
         )
-        processes.append(process)
         # create the output filename for stats
         r1_stats = os.path.join(
             output_directory,
@@ -147,17 +581,22 @@ def detect_adapters(
             os.path.basename(r2_filename).replace(fastq_suffix, known_adapter_suffix),
         )
         # run bbduk.sh to identify adapters guided by https://www.seqanswers.com/forum/bioinformatics/bioinformatics-aa/37399-introducing-bbduk-adapter-quality-trimming-and-filtering?q=ktrim
-        process = run(
-            f"bbduk.sh -Xmx4g in={r1_filename} stats={r1_stats} ref={known_adapter_filename}"
+        r1_process = run(
+            f"bbduk.sh -Xmx{memory}g in={r1_filename} stats={partial_filename(r1_stats)} ref={known_adapter_filename}"
         )
-        process = run(
-            f"bbduk.sh -Xmx4g in={r2_filename} stats={r2_stats} ref={known_adapter_filename}"
+        r2_process = run(
+            f"bbduk.sh -Xmx{memory}g in={r2_filename} stats={partial_filename(r2_stats)} ref={known_adapter_filename}"
+        )
+        jobs.append(
+            (
+                os.path.basename(r1_filename),
+                [bbmerge_process, r1_process, r2_process],
+                [(partial_filename(el), el) for el in [adapter_filename, r1_stats, r2_stats]],
+            )
         )
-        processes.append(process)
     # wait for all processes to finish
     logger.info("Waiting for bbmerge.sh and bbduk.sh processes to finish...")
-    for process in processes:
-        process.wait()
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
     logger.info(
         f"Adapter detection completed successfully with outputs written to {output_directory}"
     )
@@ -228,6 +667,29 @@ def quantify_adapters(
     return r1_adapter, r2_adapter
 
 
+def write_dominant_adapters(adapters: Tuple[str, str], output_directory: str) -> str:
+    # record the most common adapters of the samples in output_directory, without rows when none were detected
+    filename = os.path.join(output_directory, DOMINANT_ADAPTERS_FILENAME)
+    with open(partial_filename(filename), "w") as f:
+        f.write("Read\tSequence\n")
+        if adapters is not None:
+            f.write(f"read1\t{adapters[0]}\nread2\t{adapters[1]}\n")
+    os.replace(partial_filename(filename), filename)
+    logger.info(f"Dominant adapters written to {filename}")
+    return filename
+
+
+def read_dominant_adapters(output_directory: str) -> Tuple[str, str]:
+    # adapters recorded by an earlier quantify_adapters step
+    filename = os.path.join(output_directory, DOMINANT_ADAPTERS_FILENAME)
+    if not os.path.exists(filename):
+        raise ValueError(f"Trimming requires the adapters of quantify_adapters in {filename}")
+    df = pd.read_table(filename, index_col=0)
+    if len(df) == 0:
+        return None
+    return df.loc["read1", "Sequence"], df.loc["read2", "Sequence"]
+
+
 def trim_fastqs(
     r1_fastq_suffix: str,
     r2_fastq_suffix: str,
@@ -239,6 +701,8 @@ def trim_fastqs(
     trimmed_output_directory: str,
     qc_report_suffix: str,
     qc_reports_directory: str,
+    journal: str = None,
+    pipeline_step: str = None,
 ):
     # identify all read1 fastq files in the input directory
     os.makedirs(trimmed_output_directory, exist_ok=True)
@@ -249,8 +713,11 @@ def trim_fastqs(
     logger.info(
         f"Trimming adapters for {fastq_directory} N={len(r1_filenames)} files with {r1_adapter} and {r2_adapter}"
     )
-    processes = []
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
     for r1_filename in r1_filenames:
+        if os.path.basename(r1_filename) in completed:
+            continue
         # identify the corresponding read2 filename
         r2_filename = r1_filename.replace(r1_fastq_suffix, r2_fastq_suffix)
         # create the output filename for read1 and read2 trimmed fastq files
@@ -269,13 +736,18 @@ def trim_fastqs(
         )
         # run cutadapt to trim adapters from read1 and read2
         process = run(
-            f"cutadapt -a {r1_adapter} -A {r2_adapter} -m 20 -q 20 -o {r1_trimmed} -p {r2_trimmed} {r1_filename} {r2_filename} > {cutadapt_output}"
+            f"cutadapt -a {r1_adapter} -A {r2_adapter} -m 20 -q 20 -o {partial_filename(r1_trimmed)} -p {partial_filename(r2_trimmed)} {r1_filename} {r2_filename} > {partial_filename(cutadapt_output)}"
+        )
+        jobs.append(
+            (
+                os.path.basename(r1_filename),
+                [process],
+                [(partial_filename(el), el) for el in [r1_trimmed, r2_trimmed, cutadapt_output]],
+            )
         )
-        processes.append(process)
     # wait for all processes to finish
     logger.info("Waiting for cutadapt trimming processes to finish...")
-    for process in processes:
-        process.wait()
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
     logger.info(
         f"Adapter trimming completed successfully with outputs written to {trimmed_output_directory} and {qc_reports_directory}"
     )
@@ -288,46 +760,200 @@ def map_fastqs(
     mapped_output_directory: str,
     reference_genome: str,
     n_cores: int,
+    tmp_directory: str = None,
+    lane_pattern: str = None,
+    resources: Dict = None,
+    journal: str = None,
+    pipeline_step: str = None,
 ):
     # identify all read1 fastq files in the input directory
     os.makedirs(mapped_output_directory, exist_ok=True)
     r1_filenames = glob(os.path.join(fastq_directory, f"*{r1_fastq_suffix}"))
     if len(r1_filenames) == 0:
         raise ValueError(f"There are no FASTQs to map in {fastq_directory}")
-    logger.info(f"Mapping FASTQs in {fastq_directory} N={len(r1_filenames)} files")
-    processes = []
-    for r1_filename in r1_filenames:
-        # identify the corresponding read2 filename
-        r2_filename = r1_filename.replace(r1_fastq_suffix, r2_fastq_suffix)
+    # map the lanes of a sample together when a lane pattern is given
+    if lane_pattern is None:
+        r1_groups = {os.path.basename(filename): [filename] for filename in r1_filenames}
+    else:
+        r1_groups = group_lanes(filenames=r1_filenames, lane_pattern=lane_pattern)
+    logger.info(
+        f"Mapping FASTQs in {fastq_directory} N={len(r1_filenames)} files from N={len(r1_groups)} samples"
+    )
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
+    for r1_name, r1_lanes in r1_groups.items():
+        if r1_name in completed:
+            continue
+        # identify the corresponding read2 filenames, comma separated lanes are read in order by STAR
+        r1_filename = ",".join(r1_lanes)
+        r2_filename = ",".join(
+            [lane.replace(r1_fastq_suffix, r2_fastq_suffix) for lane in r1_lanes]
+        )
         prefix = os.path.join(
             mapped_output_directory,
-            os.path.basename(r1_filename).split(r1_fastq_suffix)[0],
+            r1_name.split(r1_fastq_suffix)[0],
+        )
+        # keep STAR temporary files on local scratch when requested, STAR requires it to not exist
+        tmp_option = ""
+        if tmp_directory is not None:
+            star_tmp_directory = os.path.join(tmp_directory, os.path.basename(prefix))
+            shutil.rmtree(star_tmp_directory, ignore_errors=True)
+            os.makedirs(tmp_directory, exist_ok=True)
+            tmp_option = f" --outTmpDir {star_tmp_directory}"
+        # size the threads and BAM sorting buffer of this sample when planned
+        sample = sample_name(filename=r1_name, suffix=r1_fastq_suffix)
+        threads = job_resource(
+            resources=resources, sample=sample, key="threads", default=int(n_cores)
         )
+        sort_option = ""
+        if resources:
+            sort_gb = job_resource(
+                resources=resources, sample=sample, key="scaled_memory_gb", default=1
+            )
+            sort_option = f" --limitBAMsortRAM {sort_gb * 1024 ** 3}"
+        # STAR writes every output below the hidden prefix until the sample is mapped
         process = run(
-            f"STAR --runThreadN {int(n_cores)} --genomeDir {reference_genome} --readFilesIn {r1_filename} {r2_filename} --outSAMtype BAM SortedByCoordinate --outBAMsortingThreadN {n_cores} --outFileNamePrefix {prefix} --readFilesCommand gunzip -c --quantMode GeneCounts"
+            f"STAR --runThreadN {threads} --genomeDir {reference_genome} --readFilesIn {r1_filename} {r2_filename} --outSAMtype BAM SortedByCoordinate --outBAMsortingThreadN {threads} --outFileNamePrefix {partial_filename(prefix)} --readFilesCommand gunzip -c --quantMode GeneCounts{tmp_option}{sort_option}"
+        )
+        jobs.append(
+            (
+                r1_name,
+                [process],
+                [(partial_filename(prefix + suffix), prefix + suffix) for suffix in STAR_OUTPUT_SUFFIXES],
+            )
         )
-        processes.append(process)
     # wait for all processes to finish
     logger.info("Waiting for STAR mapping processes to finish...")
-    for process in processes:
-        process.wait()
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
     logger.info(
         f"Mapping completed successfully with outputs written to {mapped_output_directory}"
     )
 
 
-def index_bams(bam_directory: str, bam_suffix: str):
+def read_tx2gene(filename: str) -> pd.Series:
+    # gene of every transcript, keyed without version suffixes so annotation releases still match
+    df = pd.read_table(filename, header=None, names=["transcript", "gene"], dtype=str)
+    return pd.Series(df["gene"].to_numpy(), index=df["transcript"].str.replace(r"\.\d+$", "", regex=True)).groupby(level=0).first()
+
+
+def collapse_transcripts(
+    quant_filename: str,
+    transcript_column: str,
+    count_column: str,
+    tx2gene: pd.Series,
+    output_filename: str,
+) -> None:
+    # sum the estimated transcript counts of every gene into a two column gene table
+    df = pd.read_table(quant_filename, usecols=[transcript_column, count_column])
+    # GENCODE transcript names carry the gene and lengths after the first "|"
+    transcripts = df[transcript_column].str.split("|").str[0].str.replace(r"\.\d+$", "", regex=True)
+    genes = transcripts.map(tx2gene)
+    if genes.isna().any():
+        logger.info(f"N={genes.isna().sum()} transcripts of {quant_filename} have no gene and are dropped")
+    counts = df[count_column].groupby(genes.to_numpy()).sum()
+    counts.index.name = "GeneID"
+    counts.name = "Counts"
+    counts.to_csv(partial_filename(output_filename), sep="\t")
+    os.replace(partial_filename(output_filename), output_filename)
+
+
+def pseudo_quantify(
+    r1_fastq_suffix: str,
+    r2_fastq_suffix: str,
+    fastq_directory: str,
+    output_directory: str,
+    aligner: str,
+    transcriptome_index: str,
+    tx2gene_filename: str,
+    count_suffix: str,
+    n_cores: int,
+    lane_pattern: str = None,
+    resources: Dict = None,
+    journal: str = None,
+    pipeline_step: str = None,
+):
+    # identify all read1 fastq files in the input directory
+    os.makedirs(output_directory, exist_ok=True)
+    r1_filenames = glob(os.path.join(fastq_directory, f"*{r1_fastq_suffix}"))
+    if len(r1_filenames) == 0:
+        raise ValueError(f"There are no FASTQs to quantify in {fastq_directory}")
+    if aligner not in PSEUDO_QUANT_FILES:
+        raise ValueError(f"Unknown pseudo-aligner {aligner}, choose from {list(PSEUDO_QUANT_FILES)}")
+    # quantify the lanes of a sample together when a lane pattern is given
+    if lane_pattern is None:
+        r1_groups = {os.path.basename(filename): [filename] for filename in r1_filenames}
+    else:
+        r1_groups = group_lanes(filenames=r1_filenames, lane_pattern=lane_pattern)
+    logger.info(
+        f"Quantifying transcripts with {aligner} for {fastq_directory} N={len(r1_filenames)} files from N={len(r1_groups)} samples"
+    )
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
+    for r1_name, r1_lanes in r1_groups.items():
+        if r1_name in completed:
+            continue
+        r2_lanes = [lane.replace(r1_fastq_suffix, r2_fastq_suffix) for lane in r1_lanes]
+        sample = sample_name(filename=r1_name, suffix=r1_fastq_suffix)
+        threads = job_resource(
+            resources=resources, sample=sample, key="threads", default=int(n_cores)
+        )
+        # each sample writes to its own hidden directory until quantified
+        quant_directory = os.path.join(output_directory, sample)
+        shutil.rmtree(partial_filename(quant_directory), ignore_errors=True)
+        # salmon takes the lanes of each mate in order, kallisto takes the lane pairs in order
+        if aligner == "salmon":
+            command = f"salmon quant -i {transcriptome_index} -l A -1 {' '.join(r1_lanes)} -2 {' '.join(r2_lanes)} -p {threads} --validateMappings -o {partial_filename(quant_directory)}"
+        else:
+            pairs = " ".join(f"{r1_lane} {r2_lane}" for r1_lane, r2_lane in zip(r1_lanes, r2_lanes))
+            command = f"kallisto quant -i {transcriptome_index} -o {partial_filename(quant_directory)} -t {threads} {pairs}"
+        process = run(command)
+        jobs.append((r1_name, [process], [(partial_filename(quant_directory), quant_directory)]))
+    # wait for all processes to finish
+    logger.info(f"Waiting for {aligner} quantification processes to finish...")
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
+    # collapse the transcripts of every sample to genes
+    tx2gene = read_tx2gene(filename=tx2gene_filename)
+    quant_name, transcript_column, count_column = PSEUDO_QUANT_FILES[aligner]
+    for r1_name in r1_groups:
+        sample = sample_name(filename=r1_name, suffix=r1_fastq_suffix)
+        collapse_transcripts(
+            quant_filename=os.path.join(output_directory, sample, quant_name),
+            transcript_column=transcript_column,
+            count_column=count_column,
+            tx2gene=tx2gene,
+            output_filename=os.path.join(output_directory, f"{sample}{count_suffix}"),
+        )
+    logger.info(
+        f"Transcript quantification completed successfully with gene counts written to {output_directory}"
+    )
+
+
+def index_bams(
+    bam_directory: str,
+    bam_suffix: str,
+    journal: str = None,
+    pipeline_step: str = None,
+):
     # identify all BAM files in the input directory
     bam_filenames = glob(f"{bam_directory}/*{bam_suffix}")
     logger.info(f"Indexing BAM files in {bam_directory} N={len(bam_filenames)} files")
-    processes = []
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
     for bam_filename in bam_filenames:
-        process = run(f"samtools index {bam_filename}")
-        processes.append(process)
+        if os.path.basename(bam_filename) in completed:
+            continue
+        index_filename = f"{bam_filename}.bai"
+        process = run(f"samtools index {bam_filename} {partial_filename(index_filename)}")
+        jobs.append(
+            (
+                os.path.basename(bam_filename),
+                [process],
+                [(partial_filename(index_filename), index_filename)],
+            )
+        )
     # wait for all processes to finish
     logger.info("Waiting for SAMtools indexing processes to finish...")
-    for process in processes:
-        process.wait()
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
     logger.info(
         f"BAM indexing completed successfully with outputs written to {bam_directory}"
     )
@@ -339,6 +965,9 @@ def dedup_bams(
     deduped_suffix: str,
     stats_suffix: str,
     stats_directory: str,
+    resources: Dict = None,
+    journal: str = None,
+    pipeline_step: str = None,
 ):
     # identify all BAM files in the input directory
     os.makedirs(stats_directory, exist_ok=True)
@@ -346,21 +975,35 @@ def dedup_bams(
     logger.info(
         "Deduplicating BAM files in %s N=%d files", bam_directory, len(bam_filenames)
     )
-    processes = []
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
     for bam_filename in bam_filenames:
+        if os.path.basename(bam_filename) in completed:
+            continue
         deduped_bam = bam_filename.replace(bam_suffix, deduped_suffix)
         deduped_stats = os.path.join(
             stats_directory,
             os.path.basename(bam_filename).replace(bam_suffix, stats_suffix),
         )
+        memory = job_resource(
+            resources=resources,
+            sample=sample_name(filename=bam_filename, suffix=bam_suffix),
+            key="memory_gb",
+            default=16,
+        )
         process = run(
-            f"java -Xmx16g -jar $PICARD MarkDuplicates I={bam_filename} O={deduped_bam} M={deduped_stats} REMOVE_DUPLICATES=true VALIDATION_STRINGENCY=LENIENT"
+            f"java -Xmx{memory}g -jar $PICARD MarkDuplicates I={bam_filename} O={partial_filename(deduped_bam)} M={partial_filename(deduped_stats)} REMOVE_DUPLICATES=true VALIDATION_STRINGENCY=LENIENT"
+        )
+        jobs.append(
+            (
+                os.path.basename(bam_filename),
+                [process],
+                [(partial_filename(el), el) for el in [deduped_bam, deduped_stats]],
+            )
         )
-        processes.append(process)
     # wait for all processes to finish
     logger.info("Waiting for PICARD deduplicating processes to finish...")
-    for process in processes:
-        process.wait()
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
     logger.info(
         "Deduplication completed successfully with outputs written to %s", bam_directory
     )
@@ -375,6 +1018,8 @@ def qc_mapped_data(
     read_distribution_suffix: str,
     reference: str,
     reference_downsampled: str,
+    journal: str = None,
+    pipeline_step: str = None,
 ):
     # identify all BAM files in the input directory
     os.makedirs(qc_reports_directory, exist_ok=True)
@@ -384,24 +1029,25 @@ def qc_mapped_data(
         bam_directory,
         len(bam_filenames),
     )
-    processes = []
+    completed = read_journal(filename=journal, pipeline_step=pipeline_step)
+    jobs = []
     for bam_filename in bam_filenames:
+        if os.path.basename(bam_filename) in completed:
+            continue
         # samtools per chromsome stats
         stats_filename = os.path.join(
             qc_reports_directory,
             os.path.basename(bam_filename).replace(bam_suffix, chr_stats_suffix),
         )
-        process = run(f"samtools idxstats {bam_filename} > {stats_filename}")
-        processes.append(process)
-        # rseqc strand inference
+        stats_process = run(f"samtools idxstats {bam_filename} > {partial_filename(stats_filename)}")
+        # rseqc strand inference, sampling reads over the small housekeeping BED rather than every gene
         strand_inference_filename = os.path.join(
             qc_reports_directory,
             os.path.basename(bam_filename).replace(bam_suffix, strand_inference_suffix),
         )
-        process = run(
-            f"infer_experiment.py -r {reference} -i {bam_filename} > {strand_inference_filename}"
+        strand_process = run(
+            f"infer_experiment.py -r {reference_downsampled} -i {bam_filename} > {partial_filename(strand_inference_filename)}"
         )
-        processes.append(process)
         # rseqc read distribution
         read_distribution_filename = os.path.join(
             qc_reports_directory,
@@ -409,26 +1055,44 @@ def qc_mapped_data(
                 bam_suffix, read_distribution_suffix
             ),
         )
-        process = run(
-            f"read_distribution.py -r {reference} -i {bam_filename} > {read_distribution_filename}"
+        distribution_process = run(
+            f"read_distribution.py -r {reference} -i {bam_filename} > {partial_filename(read_distribution_filename)}"
+        )
+        outputs = [stats_filename, strand_inference_filename, read_distribution_filename]
+        jobs.append(
+            (
+                os.path.basename(bam_filename),
+                [stats_process, strand_process, distribution_process],
+                [(partial_filename(el), el) for el in outputs],
+            )
         )
-        processes.append(process)
     # wait for all processes to finish
     logger.info("Waiting for parallelized BAM quality control to finish...")
-    for process in processes:
-        process.wait()
+    wait_for_jobs(jobs=jobs, journal=journal, pipeline_step=pipeline_step)
     logger.info(
         "Parallelized BAM quality control completed successfully with outputs written to %s",
         qc_reports_directory,
     )
-    # perform gene body coverage analysis
+    # perform gene body coverage analysis across every sample as a single unit
+    if GENE_BODY_UNIT in completed:
+        return
     logger.info("Running gene body coverage analysis...")
     bam_filenames_str = ",".join(bam_filenames)
 
     process = run(
-        f"geneBody_coverage.py -i {bam_filenames_str} -r {reference_downsampled} -o {qc_reports_directory}"
+        f"geneBody_coverage.py -i {bam_filenames_str} -r {reference_downsampled} -o {partial_filename(qc_reports_directory)}"
     )
     process.wait()
+    # the outputs are named by geneBody_coverage.py after the given prefix
+    outputs = [
+        (filename, filename.replace(partial_filename(qc_reports_directory), qc_reports_directory))
+        for filename in glob(f"{partial_filename(qc_reports_directory)}.geneBodyCoverage*")
+    ]
+    wait_for_jobs(
+        jobs=[(GENE_BODY_UNIT, [process], outputs)],
+        journal=journal,
+        pipeline_step=pipeline_step,
+    )
     logger.info(
         "Finished rseqc gene body coverage analysis with outputs written to %s",
         qc_reports_directory,
@@ -440,6 +1104,7 @@ def generate_count_matrix(
     count_directory: str,
     output_directory: str,
     output_filename: str,
+    count_format: str = "star",
 ):
     # identify all count files in the input directory
     count_files = glob(f"{count_directory}/*{count_suffix}")
@@ -449,18 +1114,69 @@ def generate_count_matrix(
     counts = []
     for count_file in count_files:
         # read in the count file and set the appropriate columns
-        df = pd.read_table(count_file, header=None)
-        df.columns = ["GeneID", "Unstranded", "Sense-Stranded", "Antisense-Stranded"]
-        df = df.iloc[4:][["GeneID", "Unstranded"]].set_index("GeneID")
+        if count_format == "star":
+            df = pd.read_table(count_file, header=None)
+            df.columns = ["GeneID", "Unstranded", "Sense-Stranded", "Antisense-Stranded"]
+            df = df.iloc[4:][["GeneID", "Unstranded"]].set_index("GeneID")
+        else:
+            # two column gene tables collapsed from pseudo-aligned transcripts
+            df = pd.read_table(count_file, index_col=0)
         df.columns = [os.path.basename(count_file).split(count_suffix)[0]]
         counts.append(df)
     counts = pd.concat(counts, axis=1).fillna(0)
     os.makedirs(output_directory, exist_ok=True)
     filename = os.path.join(output_directory, output_filename)
-    df.to_csv(filename)
+    # write next to the final name and rename so readers never see a partial matrix
+    counts.to_csv(partial_filename(filename))
+    os.replace(partial_filename(filename), filename)
     logger.info(f"Count matrix generated at {filename}")
 
 
+def resolve_tx2gene(configs: Dict) -> str:
+    # derive the transcript to gene table from the annotation when no cached one was prepared
+    if configs["tx2gene_filename"] is not None:
+        return configs["tx2gene_filename"]
+    if configs["reference_gtf"] is None:
+        raise ValueError("Pseudo quantification requires tx2gene_filename or reference_gtf")
+    filename = os.path.join(configs["pseudo_output_directory"], "tx2gene.tsv")
+    os.makedirs(configs["pseudo_output_directory"], exist_ok=True)
+    write_tx2gene(gtf_filename=configs["reference_gtf"], output_filename=partial_filename(filename))
+    os.replace(partial_filename(filename), filename)
+    return filename
+
+
+def normalize_counts(configs: Dict) -> None:
+    # derive gene lengths for TPM when no cached ones were prepared
+    gene_lengths_filename = configs["gene_lengths_filename"]
+    if "tpm" in configs["count_normalizations"] and gene_lengths_filename is None:
+        if configs["reference_gtf"] is None:
+            raise ValueError("TPM normalization requires reference_gtf for gene lengths")
+        gene_lengths_filename = os.path.join(configs["counts_output_directory"], "gene_lengths.tsv")
+        write_gene_lengths(gtf_filename=configs["reference_gtf"], output_filename=partial_filename(gene_lengths_filename))
+        os.replace(partial_filename(gene_lengths_filename), gene_lengths_filename)
+    normalize_count_matrix(
+        filename=os.path.join(configs["counts_output_directory"], configs["counts_output_filename"]),
+        methods=configs["count_normalizations"],
+        chunk_size=int(configs["normalization_chunk_size"]),
+        gene_lengths_filename=gene_lengths_filename,
+    )
+
+
+def qc_cohort(configs: Dict) -> None:
+    # correlation, PCA and outlier flags of every sample in the count matrix
+    run_cohort_qc(
+        counts_filename=os.path.join(configs["counts_output_directory"], configs["counts_output_filename"]),
+        output_directory=configs["counts_output_directory"],
+        qc_reports_directory=configs["qc_reports_directory"],
+        mito_prefix=configs["mito_gene_prefix"],
+        n_top_genes=int(configs["cohort_qc_top_genes"]),
+        n_components=int(configs["cohort_qc_components"]),
+        outlier_threshold=float(configs["cohort_outlier_threshold"]),
+        chunk_size=int(configs["normalization_chunk_size"]),
+        n_cores=int(configs["n_cores"]),
+    )
+
+
 def run_multiqc(input_directory: str, output_directory: str) -> None:
     # make directory if it does not already exist
     os.makedirs(output_directory, exist_ok=True)
@@ -473,10 +1189,143 @@ def run_multiqc(input_directory: str, output_directory: str) -> None:
     )
 
 
+def concatenate_tables(filenames: List[str], output_filename: str) -> None:
+    # stack tab separated tables with one row per sample, ordered by sample
+    tables = [pd.read_table(filename) for filename in filenames]
+    table = pd.concat(tables, axis=0, ignore_index=True)
+    table = table.sort_values(table.columns[0], kind="stable")
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    table.to_csv(output_filename, sep="\t", index=False)
+
+
+def merge_shard_tables(
+    shard_directories: List[str], relative_pattern: str, output_directory: str
+) -> None:
+    # group the matching tables of every shard by name and concatenate each group
+    tables = {}
+    for shard_directory in shard_directories:
+        for filename in glob(os.path.join(shard_directory, relative_pattern)):
+            tables.setdefault(os.path.basename(filename), []).append(filename)
+    for name, filenames in sorted(tables.items()):
+        logger.info(f"Merging {name} from N={len(filenames)} shards")
+        concatenate_tables(
+            filenames=filenames, output_filename=os.path.join(output_directory, name)
+        )
+
+
+def merge_shards(configs: Dict) -> None:
+    # identify every shard below the cohort run directory
+    shard_directories = sorted(
+        glob(os.path.join(configs["run_directory"], "shard_*_of_*"))
+    )
+    if len(shard_directories) == 0:
+        raise ValueError(f"There are no shards to merge in {configs['run_directory']}")
+    n_shards = {int(el.rsplit("_of_", 1)[1]) for el in shard_directories}
+    if len(n_shards) != 1 or len(shard_directories) != n_shards.pop():
+        raise ValueError(f"Shards in {configs['run_directory']} are incomplete: {shard_directories}")
+    logger.info(f"Merging N={len(shard_directories)} shards in {configs['run_directory']}")
+
+    def relative(key: str) -> str:
+        # location of a run directory relative to the cohort run directory
+        return os.path.relpath(configs[key], configs["run_directory"])
+
+    # combine the per-shard count matrices, samples in sorted order
+    counts = [
+        pd.read_csv(
+            os.path.join(
+                shard_directory,
+                relative("counts_output_directory"),
+                configs["counts_output_filename"],
+            ),
+            index_col=0,
+        )
+        for shard_directory in shard_directories
+    ]
+    counts = pd.concat(counts, axis=1).fillna(0)
+    counts = counts[sorted(counts.columns)]
+    os.makedirs(configs["counts_output_directory"], exist_ok=True)
+    filename = os.path.join(
+        configs["counts_output_directory"], configs["counts_output_filename"]
+    )
+    counts.to_csv(partial_filename(filename))
+    os.replace(partial_filename(filename), filename)
+    logger.info(f"Cohort count matrix of N={counts.shape[1]} samples generated at {filename}")
+    # size factors depend on the whole cohort, so normalize the merged matrix again
+    if len(configs["count_normalizations"]) > 0:
+        normalize_counts(configs=configs)
+    qc_cohort(configs=configs)
+    # gather the adapter statistics to report the cohort-wide dominant adapters
+    os.makedirs(configs["adapter_output_directory"], exist_ok=True)
+    for shard_directory in shard_directories:
+        for filename in glob(
+            os.path.join(
+                shard_directory,
+                relative("adapter_output_directory"),
+                f"*{configs['known_adapter_suffix']}",
+            )
+        ):
+            shutil.copy2(filename, configs["adapter_output_directory"])
+    adapters = quantify_adapters(
+        r1_fastq_suffix=configs["r1_fastq_suffix"],
+        r2_fastq_suffix=configs["r2_fastq_suffix"],
+        fastq_suffix=configs["fastq_suffix"],
+        known_adapter_suffix=configs["known_adapter_suffix"],
+        known_adapter_filename=configs["known_adapter_filename"],
+        output_directory=configs["adapter_output_directory"],
+    )
+    write_dominant_adapters(adapters=adapters, output_directory=configs["adapter_output_directory"])
+    # each shard trimmed with its own dominant adapters, which can differ from the cohort-wide ones
+    shard_adapters = []
+    for shard_directory in shard_directories:
+        filename = os.path.join(
+            shard_directory, relative("adapter_output_directory"), DOMINANT_ADAPTERS_FILENAME
+        )
+        if not os.path.exists(filename):
+            continue
+        df = pd.read_table(filename)
+        df.insert(0, "Shard", os.path.basename(shard_directory))
+        shard_adapters.append(df)
+        if adapters is not None and list(df["Sequence"]) != list(adapters):
+            logger.info(f"Shard {os.path.basename(shard_directory)} trimmed other adapters than the cohort-wide ones")
+    if len(shard_adapters) > 0:
+        filename = os.path.join(configs["adapter_output_directory"], SHARD_ADAPTERS_FILENAME)
+        pd.concat(shard_adapters).to_csv(partial_filename(filename), sep="\t", index=False)
+        os.replace(partial_filename(filename), filename)
+        logger.info(f"Adapters trimmed by each shard written to {filename}")
+    # stack the per-sample QC tables from MultiQC and gene body coverage
+    merge_shard_tables(
+        shard_directories=shard_directories,
+        relative_pattern=os.path.join(
+            relative("multiqc_output_directory"), "multiqc_data", "multiqc_*.txt"
+        ),
+        output_directory=os.path.join(configs["multiqc_output_directory"], "multiqc_data"),
+    )
+    merge_shard_tables(
+        shard_directories=shard_directories,
+        relative_pattern=os.path.join(
+            relative("qc_reports_directory"), "*.geneBodyCoverage.txt"
+        ),
+        output_directory=configs["qc_reports_directory"],
+    )
+    logger.info(f"Shards merged into {configs['run_directory']}")
+
+
 def skip_step(pipeline_step: str, configs: str) -> bool:
+    if pipeline_step == "select_shard":
+        if configs["shard"] is None:
+            return True
+    if pipeline_step == "merge_lanes":
+        if configs["lane_merge_mode"] != "concatenate":
+            return True
     if pipeline_step in ["trim_fastq", "qc_trimmed_fastq"]:
         if configs["skip_trimming"]:
             return True
+    if pipeline_step in BAM_STEPS:
+        if configs["quantification_mode"] == "pseudo":
+            return True
+    if pipeline_step == "quantify_transcripts":
+        if configs["quantification_mode"] != "pseudo":
+            return True
     return False
 
 
@@ -484,11 +1333,47 @@ def executor(pipeline_step: str, configs: Dict) -> Dict:
     # create a tracker variable for outputs incase we need to update
     new_configs = {}
     # execute the pipeline step based on the given step name
-    if pipeline_step == "qc_raw_fastq":
+    if pipeline_step == "select_shard":
+        select_shard(
+            r1_fastq_suffix=configs["r1_fastq_suffix"],
+            r2_fastq_suffix=configs["r2_fastq_suffix"],
+            fastq_directory=configs["shard_source_directory"],
+            shard=configs["shard"],
+            lane_pattern=configs["lane_pattern"] if configs["lane_merge_mode"] else None,
+            output_directory=configs["shard_fastq_directory"],
+        )
+    elif pipeline_step == "merge_lanes":
+        merge_lanes(
+            r1_fastq_suffix=configs["r1_fastq_suffix"],
+            r2_fastq_suffix=configs["r2_fastq_suffix"],
+            fastq_directory=configs["lane_fastq_directory"],
+            lane_pattern=configs["lane_pattern"],
+            output_directory=configs["merged_fastq_directory"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
+        )
+    elif pipeline_step == "validate_inputs":
+        validated_directory = validate_inputs(
+            r1_fastq_suffix=configs["r1_fastq_suffix"],
+            r2_fastq_suffix=configs["r2_fastq_suffix"],
+            fastq_suffix=configs["fastq_suffix"],
+            fastq_directory=configs["raw_fastq_directory"],
+            cache_filename=configs["validation_cache_filename"],
+            invalid_input_action=configs["invalid_input_action"],
+            n_cores=configs["n_cores"],
+            report_directory=configs["qc_reports_directory"],
+            output_directory=configs["validated_fastq_directory"],
+        )
+        # read only the valid samples from here on
+        if validated_directory is not None:
+            new_configs["raw_fastq_directory"] = validated_directory
+    elif pipeline_step == "qc_raw_fastq":
         run_fastqc(
             fastq_suffix=configs["fastq_suffix"],
             fastq_directory=configs["raw_fastq_directory"],
             output_directory=configs["raw_fastqc_directory"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "detect_adapters":
         detect_adapters(
@@ -500,6 +1385,14 @@ def executor(pipeline_step: str, configs: Dict) -> Dict:
             known_adapter_filename=configs["known_adapter_filename"],
             known_adapter_suffix=configs["known_adapter_suffix"],
             output_directory=configs["adapter_output_directory"],
+            lane_pattern=(
+                configs["lane_pattern"]
+                if configs["lane_merge_mode"] == "star"
+                else None
+            ),
+            resources=configs["resources"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "quantify_adapters":
         output = quantify_adapters(
@@ -510,6 +1403,7 @@ def executor(pipeline_step: str, configs: Dict) -> Dict:
             known_adapter_filename=configs["known_adapter_filename"],
             output_directory=configs["adapter_output_directory"],
         )
+        write_dominant_adapters(adapters=output, output_directory=configs["adapter_output_directory"])
         # early return if no adapters were detected
         if output is None:
             new_configs["skip_trimming"] = True
@@ -520,6 +1414,15 @@ def executor(pipeline_step: str, configs: Dict) -> Dict:
         new_configs["r1_adapter"] = r1_adapter
         new_configs["r2_adapter"] = r2_adapter
     elif pipeline_step == "trim_fastq":
+        # runs starting from trimming read back the adapters of the earlier run
+        if "r1_adapter" not in configs:
+            adapters = read_dominant_adapters(output_directory=configs["adapter_output_directory"])
+            if adapters is None:
+                logger.info("No adapters were detected, skipping trimming")
+                new_configs["skip_trimming"] = True
+                return new_configs
+            configs["r1_adapter"], configs["r2_adapter"] = adapters
+            new_configs["r1_adapter"], new_configs["r2_adapter"] = adapters
         trim_fastqs(
             r1_fastq_suffix=configs["r1_fastq_suffix"],
             r2_fastq_suffix=configs["r2_fastq_suffix"],
@@ -531,12 +1434,43 @@ def executor(pipeline_step: str, configs: Dict) -> Dict:
             trimmed_output_directory=configs["trimmed_fastq_directory"],
             qc_report_suffix=configs["cutadapt_output_suffix"],
             qc_reports_directory=configs["cutadapt_output_directory"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "qc_trimmed_fastq":
         run_fastqc(
             fastq_suffix=configs["trimmed_suffix"],
             fastq_directory=configs["trimmed_fastq_directory"],
             output_directory=configs["trimmed_fastqc_directory"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
+        )
+    elif pipeline_step == "quantify_transcripts":
+        # quantify the raw reads when no adapters needed trimming
+        if configs["skip_trimming"]:
+            r1_suffix, r2_suffix = configs["r1_fastq_suffix"], configs["r2_fastq_suffix"]
+            fastq_directory = configs["raw_fastq_directory"]
+        else:
+            r1_suffix, r2_suffix = configs["r1_trimmed_fastq_suffix"], configs["r2_trimmed_fastq_suffix"]
+            fastq_directory = configs["trimmed_fastq_directory"]
+        pseudo_quantify(
+            r1_fastq_suffix=r1_suffix,
+            r2_fastq_suffix=r2_suffix,
+            fastq_directory=fastq_directory,
+            output_directory=configs["pseudo_output_directory"],
+            aligner=configs["pseudo_aligner"],
+            transcriptome_index=configs["transcriptome_index"],
+            tx2gene_filename=resolve_tx2gene(configs=configs),
+            count_suffix=configs["pseudo_count_suffix"],
+            n_cores=configs["n_cores"],
+            lane_pattern=(
+                configs["lane_pattern"]
+                if configs["lane_merge_mode"] == "star"
+                else None
+            ),
+            resources=configs["resources"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "map_fastq_to_bam":
         map_fastqs(
@@ -546,11 +1480,26 @@ def executor(pipeline_step: str, configs: Dict) -> Dict:
             mapped_output_directory=configs["mapped_bam_directory"],
             reference_genome=configs["reference_genome"],
             n_cores=configs["n_cores"],
+            tmp_directory=(
+                os.path.join(configs["scratch_run_directory"], "star_tmp")
+                if configs.get("scratch_directory")
+                else None
+            ),
+            lane_pattern=(
+                configs["lane_pattern"]
+                if configs["lane_merge_mode"] == "star"
+                else None
+            ),
+            resources=configs["resources"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "index_bam":
         index_bams(
             bam_directory=configs["mapped_bam_directory"],
             bam_suffix=configs["bam_nondedup_suffix"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "dedup_bam":
         dedup_bams(
@@ -559,11 +1508,16 @@ def executor(pipeline_step: str, configs: Dict) -> Dict:
             deduped_suffix=configs["deduped_suffix"],
             stats_suffix=configs["dedup_stats_suffix"],
             stats_directory=configs["dedup_stats_directory"],
+            resources=configs["resources"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "index_dedup_bam":
         index_bams(
             bam_directory=configs["mapped_bam_directory"],
             bam_suffix=configs["deduped_suffix"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "qc_nondedup_bam":
         qc_mapped_data(
@@ -575,14 +1529,22 @@ def executor(pipeline_step: str, configs: Dict) -> Dict:
             read_distribution_suffix=configs["read_distribution_suffix"],
             reference=configs["bam_qc_reference"],
             reference_downsampled=configs["bam_qc_reference_downsampled"],
+            journal=configs["journal_filename"],
+            pipeline_step=pipeline_step,
         )
     elif pipeline_step == "aggregate_counts":
+        pseudo = configs["quantification_mode"] == "pseudo"
         generate_count_matrix(
-            count_suffix=configs["count_suffix"],
-            count_directory=configs["mapped_bam_directory"],
+            count_suffix=configs["pseudo_count_suffix"] if pseudo else configs["count_suffix"],
+            count_directory=configs["pseudo_output_directory"] if pseudo else configs["mapped_bam_directory"],
             output_directory=configs["counts_output_directory"],
             output_filename=configs["counts_output_filename"],
+            count_format="gene_table" if pseudo else "star",
         )
+        if len(configs["count_normalizations"]) > 0:
+            normalize_counts(configs=configs)
+    elif pipeline_step == "qc_cohort":
+        qc_cohort(configs=configs)
     elif pipeline_step == "aggregate_qc_reports":
         run_multiqc(
             input_directory=configs["qc_reports_directory"],
@@ -611,15 +1573,78 @@ def main():
         default="BulkPipeline.log",
         help="Path to the log file",
     )
+    parser.add_argument(
+        "-s",
+        "--shard",
+        type=str,
+        default=None,
+        help="Only run the samples of shard i/N (i counting from 1) in run_directory/shard_i_of_N",
+    )
+    parser.add_argument(
+        "-m",
+        "--merge_shards",
+        action="store_true",
+        help="Merge the count matrices, adapter statistics and QC tables of every shard in run_directory",
+    )
+    parser.add_argument(
+        "-p",
+        "--plan",
+        action="store_true",
+        help="Report the estimated memory, wall time and core-hours of every job without running anything",
+    )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        action="store_true",
+        help="Skip every (step, sample) unit the journal in run_directory records as completed",
+    )
     args = parser.parse_args()
     
     # configure logger and pipeline
     setup_logger(filename=args.log_file)
     configs = load_configs(filename=args.configuration_file)
+    configs["shard"] = args.shard
     configs = configure_config(configs=configs)
 
+    # combine finished shards instead of running the pipeline
+    if args.merge_shards:
+        merge_shards(configs=configs)
+        write_status("INFO: Shards merged.")
+        return
+
     # identify where to begin the pipeline
     pipeline_steps = identify_start_step(configs=configs, pipeline_steps=PIPELINE_STEPS)
+    consumers = count_consumers(pipeline_steps=pipeline_steps)
+    history = load_history(filename=configs["timing_history_filename"])
+
+    # estimate the resources of every job before anything launches
+    if args.plan:
+        # leave out the steps the run would skip, e.g. BAM steps in pseudo mode
+        planned_steps = [step for step in pipeline_steps if not skip_step(pipeline_step=step, configs=configs)]
+        rows = build_plan(configs=configs, pipeline_steps=planned_steps, history=history)
+        os.makedirs(configs["run_directory"], exist_ok=True)
+        report = report_plan(
+            rows=rows, filename=os.path.join(configs["run_directory"], "pipeline_plan.tsv")
+        )
+        print(report)
+        return
+
+    # point the run at the cached reference assets, building any that are missing
+    if configs["reference_cache_directory"] is not None:
+        configs.update(prepare_references(configs=configs))
+
+    # pseudo-alignment needs a prebuilt or cached transcriptome index
+    if configs["quantification_mode"] == "pseudo" and configs["transcriptome_index"] is None:
+        raise ValueError(
+            "Pseudo quantification requires transcriptome_index, or transcriptome_fasta with reference_cache_directory"
+        )
+
+    # keep the completed units of the steps to run only when resuming
+    os.makedirs(configs["run_directory"], exist_ok=True)
+    if args.resume:
+        logger.info(f"Resuming from the units completed in {configs['journal_filename']}")
+    else:
+        reset_journal(filename=configs["journal_filename"], pipeline_steps=pipeline_steps)
 
     # work through each step in the pipeline
     for step in pipeline_steps:
@@ -628,16 +1653,39 @@ def main():
         skip_this_step = skip_step(pipeline_step=step, configs=configs)
         if skip_this_step:
             write_status(f"STATUS: {step} skipped")
+            release_intermediates(pipeline_step=step, configs=configs, consumers=consumers)
             continue
         try:
+            # size each job of this step from its current inputs
+            input_sizes = {}
+            if step in RESOURCE_MODELS:
+                input_sizes = measure_inputs(configs=configs, pipeline_step=step)
+            if configs["auto_resources"]:
+                configs["resources"] = plan_step(configs=configs, pipeline_step=step, history=history)
             # update configuration
             write_status(f"STATUS: {step} in_progress")
+            start = time.time()
             new_configs = executor(pipeline_step=step, configs=configs)
             configs.update(new_configs)
+            # remember how long this step took for future estimates
+            if step in RESOURCE_MODELS:
+                record_history(
+                    filename=configs["timing_history_filename"],
+                    pipeline_step=step,
+                    input_sizes=input_sizes,
+                    seconds=time.time() - start,
+                    n_cores=int(configs["n_cores"]),
+                )
+            stage_final_outputs(pipeline_step=step, configs=configs)
+            release_intermediates(pipeline_step=step, configs=configs, consumers=consumers)
             write_status(f"STATUS: {step} finished")
         except Exception as e:
             logger.error(f"Error in pipeline step {step}: {e}")
             raise ValueError(f"Error in pipeline step {step}: {e}")
+    # clear the local scratch space of this run
+    if configs.get("scratch_directory") and not configs["keep_intermediates"]:
+        logger.info(f"Removing scratch directory {configs['scratch_run_directory']}")
+        shutil.rmtree(configs["scratch_run_directory"], ignore_errors=True)
     logger.info("Pipeline completed successfully!")
     write_status("INFO: Pipeline finished.")
 
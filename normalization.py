@@ -0,0 +1,143 @@
+import logging
+import os
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterator, List
+from constants import *
+
+# create a logger object writing to the given file
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def normalized_filename(filename: str, method: str) -> str:
+    # e.g. raw_counts.tsv -> raw_counts.cpm.tsv
+    root, extension = os.path.splitext(filename)
+    return f"{root}.{method}{extension}"
+
+
+def read_gene_lengths(filename: str) -> pd.Series:
+    # gene lengths in kilobases indexed by gene id
+    df = pd.read_table(filename, index_col=0)
+    return df.iloc[:, 0].astype(float) / 1000
+
+
+def iterate_chunks(filename: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    # stream the (genes x samples) count matrix a block of genes at a time
+    for chunk in pd.read_csv(filename, index_col=0, chunksize=chunk_size):
+        yield chunk
+
+
+def chunk_lengths(chunk: pd.DataFrame, gene_lengths: pd.Series) -> np.ndarray:
+    # lengths of the genes of a chunk, NaN for genes missing from the annotation
+    return gene_lengths.reindex(chunk.index).to_numpy()
+
+
+def accumulate_ratio_histogram(counts: np.ndarray, histogram: np.ndarray) -> int:
+    # add the log ratios to the gene geometric means of genes expressed in every sample
+    expressed = (counts > 0).all(axis=1)
+    if not expressed.any():
+        return 0
+    log_counts = np.log(counts[expressed])
+    log_ratios = log_counts - log_counts.mean(axis=1, keepdims=True)
+    n_bins, n_samples = histogram.shape
+    bins = (log_ratios - SIZE_FACTOR_LOG_RANGE[0]) / (SIZE_FACTOR_LOG_RANGE[1] - SIZE_FACTOR_LOG_RANGE[0]) * n_bins
+    bins = np.clip(bins.astype(np.int64), 0, n_bins - 1)
+    # one bincount over (bin, sample) pairs updates every sample at once
+    histogram += np.bincount(
+        (bins * n_samples + np.arange(n_samples)).ravel(), minlength=n_bins * n_samples
+    ).reshape(n_bins, n_samples).astype(histogram.dtype)
+    return int(expressed.sum())
+
+
+def histogram_median(histogram: np.ndarray, n_values: int) -> np.ndarray:
+    # median of each column, interpolated linearly within the bin holding it
+    n_bins = histogram.shape[0]
+    width = (SIZE_FACTOR_LOG_RANGE[1] - SIZE_FACTOR_LOG_RANGE[0]) / n_bins
+    cumulative = np.cumsum(histogram, axis=0)
+    half = n_values / 2
+    median_bins = (cumulative < half).sum(axis=0)
+    columns = np.arange(histogram.shape[1])
+    before = np.where(median_bins > 0, cumulative[np.maximum(median_bins - 1, 0), columns], 0)
+    inside = np.maximum(histogram[median_bins, columns], 1)
+    return SIZE_FACTOR_LOG_RANGE[0] + (median_bins + (half - before) / inside) * width
+
+
+def normalize_count_matrix(
+    filename: str,
+    methods: List[str],
+    chunk_size: int,
+    gene_lengths_filename: str = None,
+) -> Dict[str, str]:
+    # compute normalized matrices in two streaming passes over the raw count matrix
+    unknown = set(methods) - set(COUNT_NORMALIZATIONS)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown count normalizations {sorted(unknown)}, choose from {COUNT_NORMALIZATIONS}")
+    gene_lengths = None
+    if "tpm" in methods:
+        if gene_lengths_filename is None:
+            raise ValueError("TPM normalization requires gene lengths from reference_gtf")
+        gene_lengths = read_gene_lengths(filename=gene_lengths_filename)
+    logger.info(f"Normalizing {filename} with {methods} in chunks of {chunk_size} genes")
+
+    # first pass: per-sample totals and the log ratio histogram for size factors
+    library_sizes, rate_sums, histogram, n_ratios, n_missing = None, None, None, 0, 0
+    for chunk in iterate_chunks(filename=filename, chunk_size=chunk_size):
+        counts = chunk.to_numpy(dtype=np.float64)
+        if library_sizes is None:
+            library_sizes = np.zeros(counts.shape[1])
+            rate_sums = np.zeros(counts.shape[1])
+            histogram = np.zeros((SIZE_FACTOR_BINS, counts.shape[1]), dtype=np.int32)
+        library_sizes += counts.sum(axis=0)
+        if "tpm" in methods:
+            lengths = chunk_lengths(chunk=chunk, gene_lengths=gene_lengths)
+            n_missing += int(np.isnan(lengths).sum())
+            known = ~np.isnan(lengths)
+            rate_sums += (counts[known] / lengths[known, None]).sum(axis=0)
+        if "size_factors" in methods:
+            n_ratios += accumulate_ratio_histogram(counts=counts, histogram=histogram)
+    if library_sizes is None:
+        raise ValueError(f"There are no genes to normalize in {filename}")
+    if n_missing > 0:
+        logger.info(f"Dropping N={n_missing} genes without a length from the TPM matrix")
+    size_factors = None
+    if "size_factors" in methods:
+        if n_ratios == 0:
+            raise ValueError("No gene is expressed in every sample, size factors are undefined")
+        size_factors = np.exp(histogram_median(histogram=histogram, n_values=n_ratios))
+        logger.info(f"Size factors estimated from N={n_ratios} genes expressed in every sample")
+    library_sizes = np.maximum(library_sizes, 1)
+    rate_sums = np.maximum(rate_sums, np.finfo(float).tiny)
+
+    # second pass: normalize each chunk and append it to every output
+    outputs = {method: normalized_filename(filename=filename, method=method) for method in methods}
+    partials = {
+        method: os.path.join(os.path.dirname(output), PARTIAL_PREFIX + os.path.basename(output))
+        for method, output in outputs.items()
+    }
+    first = True
+    for chunk in iterate_chunks(filename=filename, chunk_size=chunk_size):
+        counts = chunk.to_numpy(dtype=np.float64)
+        normalized = {}
+        if "cpm" in methods or "log1p_cpm" in methods:
+            cpm = counts / library_sizes * 1e6
+            normalized["cpm"] = pd.DataFrame(cpm, index=chunk.index, columns=chunk.columns)
+            normalized["log1p_cpm"] = pd.DataFrame(np.log1p(cpm), index=chunk.index, columns=chunk.columns)
+        if "tpm" in methods:
+            lengths = chunk_lengths(chunk=chunk, gene_lengths=gene_lengths)
+            known = ~np.isnan(lengths)
+            tpm = counts[known] / lengths[known, None] / rate_sums * 1e6
+            normalized["tpm"] = pd.DataFrame(tpm, index=chunk.index[known], columns=chunk.columns)
+        if "size_factors" in methods:
+            normalized["size_factors"] = pd.DataFrame(
+                counts / size_factors, index=chunk.index, columns=chunk.columns
+            )
+        for method in methods:
+            normalized[method].to_csv(
+                partials[method], mode="w" if first else "a", header=first, float_format="%.8g"
+            )
+        first = False
+    for method in methods:
+        os.replace(partials[method], outputs[method])
+        logger.info(f"Normalized {method} matrix generated at {outputs[method]}")
+    return outputs
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import re
+import statistics
+import time
+from glob import glob
+from typing import Dict, List
+from constants import *
+
+# create a logger object writing to the given file
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def sample_name(filename: str, suffix: str) -> str:
+    # name shared by every file of a sample, e.g. "test" for test_read1.fastq.gz and test_Aligned.sortedByCoord.out.bam
+    return os.path.basename(filename).split(suffix)[0].rstrip("_")
+
+
+def fastq_sizes(
+    fastq_directory: str, r1_fastq_suffix: str, r2_fastq_suffix: str, lane_pattern: str = None
+) -> Dict[str, int]:
+    # total bytes of read1 and read2 per sample, summing every lane when a lane pattern is given
+    sizes = {}
+    for r1_filename in glob(os.path.join(fastq_directory, f"*{r1_fastq_suffix}")):
+        r2_filename = r1_filename.replace(r1_fastq_suffix, r2_fastq_suffix)
+        name = os.path.basename(r1_filename)
+        if lane_pattern is not None:
+            name = re.sub(lane_pattern, "", name, count=1)
+        sample = sample_name(filename=name, suffix=r1_fastq_suffix)
+        sizes[sample] = sizes.get(sample, 0) + sum(
+            os.path.getsize(filename) for filename in [r1_filename, r2_filename] if os.path.exists(filename)
+        )
+    return sizes
+
+
+def bam_sizes(bam_directory: str, bam_suffix: str) -> Dict[str, int]:
+    # bytes of each BAM per sample
+    return {
+        sample_name(filename=filename, suffix=bam_suffix): os.path.getsize(filename)
+        for filename in glob(os.path.join(bam_directory, f"*{bam_suffix}"))
+    }
+
+
+def measure_inputs(configs: Dict, pipeline_step: str) -> Dict[str, int]:
+    # find the input bytes of each job of a step, falling back to the raw FASTQs for inputs not made yet
+    lane_pattern = configs["lane_pattern"] if configs["lane_merge_mode"] is not None else None
+    # concatenated lanes are as large as their lane files, which exist before merge_lanes runs
+    raw_sizes = fastq_sizes(
+        fastq_directory=configs.get("lane_fastq_directory", configs["raw_fastq_directory"]),
+        r1_fastq_suffix=configs["r1_fastq_suffix"],
+        r2_fastq_suffix=configs["r2_fastq_suffix"],
+        lane_pattern=lane_pattern,
+    )
+    model = RESOURCE_MODELS[pipeline_step]
+    if model["input"] == "trimmed":
+        sizes = fastq_sizes(
+            fastq_directory=configs["trimmed_fastq_directory"],
+            r1_fastq_suffix=configs["r1_trimmed_fastq_suffix"],
+            r2_fastq_suffix=configs["r2_trimmed_fastq_suffix"],
+            lane_pattern=lane_pattern,
+        )
+        if len(sizes) > 0:
+            return sizes
+    elif model["input"] == "bam":
+        sizes = bam_sizes(
+            bam_directory=configs["mapped_bam_directory"],
+            bam_suffix=configs["bam_nondedup_suffix"],
+        )
+        if len(sizes) > 0:
+            return sizes
+        return {sample: int(size * BAM_PER_FASTQ_BYTES) for sample, size in raw_sizes.items()}
+    return raw_sizes
+
+
+def load_history(filename: str) -> List[Dict]:
+    # read in the timings recorded by earlier runs
+    if not os.path.exists(filename):
+        return []
+    with open(filename, "r") as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
+
+
+def record_history(filename: str, pipeline_step: str, input_sizes: Dict[str, int], seconds: float, n_cores: int) -> None:
+    # append the timing of a finished step for future estimates
+    record = {
+        "step": pipeline_step,
+        "n_jobs": len(input_sizes),
+        "input_gb": sum(input_sizes.values()) / 1024 ** 3,
+        "seconds": seconds,
+        "n_cores": n_cores,
+        "timestamp": time.time(),
+    }
+    with open(filename, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def seconds_per_gb(pipeline_step: str, history: List[Dict]) -> float:
+    # jobs run concurrently, so a step takes about as long as its average job
+    rates = [
+        record["seconds"] / (record["input_gb"] / record["n_jobs"])
+        for record in history
+        if record["step"] == pipeline_step and record["n_jobs"] > 0 and record["input_gb"] > 0
+    ]
+    if len(rates) == 0:
+        return RESOURCE_MODELS[pipeline_step]["seconds_per_input_gb"]
+    return statistics.median(rates)
+
+
+def plan_step(configs: Dict, pipeline_step: str, history: List[Dict]) -> Dict[str, Dict]:
+    # predict the wall time, peak memory and threads of every job of a step
+    if pipeline_step not in RESOURCE_MODELS:
+        return {}
+    model = RESOURCE_MODELS[pipeline_step]
+    input_sizes = measure_inputs(configs=configs, pipeline_step=pipeline_step)
+    rate = seconds_per_gb(pipeline_step=pipeline_step, history=history)
+    # split the cores across the concurrent jobs for multi-threaded tools
+    threads = model["threads"]
+    if threads == 0:
+        threads = max(1, int(configs["n_cores"]) // max(1, len(input_sizes)))
+    plan = {}
+    for sample, size in input_sizes.items():
+        input_gb = size / 1024 ** 3
+        scaled_gb = model["memory_per_input_gb"] * input_gb
+        plan[sample] = {
+            "input_gb": input_gb,
+            "memory_gb": int(min(model["memory_max_gb"], model["memory_base_gb"] + scaled_gb) + 0.999),
+            "scaled_memory_gb": int(min(model["memory_max_gb"] - model["memory_base_gb"], max(1, scaled_gb)) + 0.999),
+            "threads": threads,
+            "seconds": rate * input_gb,
+        }
+    return plan
+
+
+def build_plan(configs: Dict, pipeline_steps: List[str], history: List[Dict]) -> List[Dict]:
+    # flatten the plan of every step into one row per job
+    rows = []
+    for pipeline_step in pipeline_steps:
+        for sample, job in plan_step(configs=configs, pipeline_step=pipeline_step, history=history).items():
+            rows.append(dict(step=pipeline_step, sample=sample, **job))
+    return rows
+
+
+def report_plan(rows: List[Dict], filename: str) -> str:
+    # write every job and summarize each step, steps run one after another with their jobs in parallel
+    columns = ["step", "sample", "input_gb", "memory_gb", "scaled_memory_gb", "threads", "seconds"]
+    with open(filename, "w") as f:
+        f.write("\t".join(columns) + "\n")
+        for row in rows:
+            f.write("\t".join(str(row[column]) for column in columns) + "\n")
+    lines = [f"{'step':<20}{'jobs':>6}{'peak_gb':>10}{'wall_h':>10}{'core_h':>10}"]
+    total_wall, total_core = 0, 0
+    for pipeline_step in dict.fromkeys(row["step"] for row in rows):
+        jobs = [row for row in rows if row["step"] == pipeline_step]
+        wall = max(job["seconds"] for job in jobs) / 3600
+        core = sum(job["seconds"] * job["threads"] for job in jobs) / 3600
+        peak = sum(job["memory_gb"] for job in jobs)
+        total_wall, total_core = total_wall + wall, total_core + core
+        lines.append(f"{pipeline_step:<20}{len(jobs):>6}{peak:>10}{wall:>10.2f}{core:>10.2f}")
+    lines.append(f"{'total':<20}{'':>6}{'':>10}{total_wall:>10.2f}{total_core:>10.2f}")
+    report = "\n".join(lines)
+    logger.info(f"Resource plan written to {filename}\n{report}")
+    return report
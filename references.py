@@ -0,0 +1,313 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import zlib
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, List
+from constants import *
+
+# create a logger object writing to the given file
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def hash_file(filename: str, chunk_size: int = 1 << 20) -> str:
+    # checksum of the file contents, read in chunks to keep memory flat on genome sized files
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def checksum(filename: str, cache_directory: str) -> str:
+    # checksum of a reference, only recomputed when its size or modification time changed
+    memo_filename = os.path.join(cache_directory, REFERENCE_CHECKSUMS_FILENAME)
+    memo = {}
+    if os.path.exists(memo_filename):
+        with open(memo_filename, "r") as f:
+            memo = json.load(f)
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    entry = memo.get(filename)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha1"]
+    logger.info(f"Computing the checksum of {filename}")
+    memo[filename] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": hash_file(filename)}
+    partial = os.path.join(cache_directory, f"{PARTIAL_PREFIX}{os.getpid()}.{REFERENCE_CHECKSUMS_FILENAME}")
+    with open(partial, "w") as f:
+        json.dump(memo, f, indent=2)
+    os.replace(partial, memo_filename)
+    return memo[filename]["sha1"]
+
+
+def combine_keys(keys: List[str]) -> str:
+    # one key for an asset derived from several inputs and parameters
+    return hashlib.sha1("\t".join(keys).encode()).hexdigest()
+
+
+def cached_asset(cache_directory: str, key: str, name: str, build: Callable[[str], None]) -> str:
+    # build an asset once under its key, written to a hidden name and renamed when complete
+    asset_directory = os.path.join(cache_directory, key[:16])
+    filename = os.path.join(asset_directory, name)
+    if os.path.exists(filename):
+        logger.info(f"Using cached {name} at {filename}")
+        return filename
+    # the process id keeps concurrent runs, e.g. shards sharing a cache, from writing into each other
+    os.makedirs(asset_directory, exist_ok=True)
+    partial = os.path.join(asset_directory, f"{PARTIAL_PREFIX}{os.getpid()}.{name}")
+    logger.info(f"Building {name} at {filename}")
+    build(partial)
+    if os.path.exists(filename):
+        shutil.rmtree(partial) if os.path.isdir(partial) else os.remove(partial)
+    else:
+        os.replace(partial, filename)
+    return filename
+
+
+def read_bed(filename: str) -> pd.DataFrame:
+    # read a BED file of any width, skipping the track, browser and comment lines at its top
+    n_header = 0
+    with open(filename, "r") as f:
+        for line in f:
+            if not line.startswith(("track", "browser", "#")):
+                break
+            n_header += 1
+    df = pd.read_table(filename, header=None, skiprows=n_header, dtype={0: str, 3: str})
+    return df.astype({1: np.int64, 2: np.int64})
+
+
+def write_sorted_bed(bed_filename: str, output_filename: str) -> None:
+    # sort by chromosome, start and end and drop duplicated records
+    df = read_bed(filename=bed_filename).drop_duplicates()
+    df = df.sort_values([0, 1, 2], kind="stable")
+    df.to_csv(output_filename, sep="\t", header=False, index=False)
+
+
+def strip_version(name: str) -> str:
+    # compare accessions without their version, e.g. NM_000546.6 -> NM_000546
+    return re.sub(r"\.\d+$", "", name).upper()
+
+
+def read_gene_names(gtf_filename: str) -> Dict[str, str]:
+    # gene name of every transcript and gene ID in the GTF, streamed
+    names = {}
+    opener = gzip.open if gtf_filename.endswith(".gz") else open
+    with opener(gtf_filename, "rt") as f:
+        for line in f:
+            fields = line.split("\t")
+            if line.startswith("#") or len(fields) < 9:
+                continue
+            gene_name = re.search(r'gene_name "([^"]+)"', fields[8])
+            if gene_name is None:
+                continue
+            for key in ["transcript_id", "gene_id"]:
+                match = re.search(rf'{key} "([^"]+)"', fields[8])
+                if match is not None:
+                    names[strip_version(match.group(1))] = gene_name.group(1).upper()
+    return names
+
+
+def write_downsampled_bed(
+    sorted_bed_filename: str,
+    output_filename: str,
+    n_genes: int,
+    housekeeping_filename: str = None,
+    gtf_filename: str = None,
+) -> None:
+    # keep the housekeeping genes, named directly or through the transcript and gene IDs of the GTF
+    df = read_bed(filename=sorted_bed_filename)
+    if housekeeping_filename is not None:
+        with open(housekeeping_filename, "r") as f:
+            genes = {line.strip().upper() for line in f if line.strip() != ""}
+    else:
+        genes = {gene.upper() for gene in HOUSEKEEPING_GENES}
+    gene_names = {} if gtf_filename is None else read_gene_names(gtf_filename=gtf_filename)
+    names = df[3].map(strip_version)
+    keep = names.isin(genes) | names.map(gene_names).isin(genes)
+    if keep.any():
+        logger.info(f"Kept N={keep.sum()} intervals of housekeeping genes in the downsampled BED")
+        df = df[keep]
+    elif housekeeping_filename is not None:
+        raise ValueError(f"No genes of {housekeeping_filename} were found in {sorted_bed_filename}")
+    else:
+        # without matching names, e.g. accessions and no GTF, rank names by a stable hash instead
+        logger.info(
+            f"No default housekeeping genes found in {sorted_bed_filename}, set reference_gtf to translate its names, "
+            f"sampling N={n_genes} genes instead"
+        )
+        ranked = sorted(df[3].unique(), key=lambda name: (zlib.crc32(name.encode()), name))
+        df = df[df[3].isin(set(ranked[:n_genes]))]
+    df.to_csv(output_filename, sep="\t", header=False, index=False)
+
+
+def write_gene_lengths(gtf_filename: str, output_filename: str) -> None:
+    # length of the union of the exons of every gene, streamed from the GTF
+    exons = {}
+    opener = gzip.open if gtf_filename.endswith(".gz") else open
+    with opener(gtf_filename, "rt") as f:
+        for line in f:
+            fields = line.split("\t")
+            if line.startswith("#") or len(fields) < 9 or fields[2] != "exon":
+                continue
+            match = re.search(r'gene_id "([^"]+)"', fields[8])
+            if match is None:
+                continue
+            exons.setdefault(match.group(1), []).append((int(fields[3]), int(fields[4])))
+    with open(output_filename, "w") as f:
+        f.write("GeneID\tLength\n")
+        for gene, intervals in exons.items():
+            # merge overlapping exons of different transcripts, GTF coordinates are closed
+            length, current_start, current_end = 0, None, None
+            for start, end in sorted(intervals):
+                if current_end is None or start > current_end:
+                    if current_end is not None:
+                        length += current_end - current_start + 1
+                    current_start, current_end = start, end
+                else:
+                    current_end = max(current_end, end)
+            length += current_end - current_start + 1
+            f.write(f"{gene}\t{length}\n")
+
+
+def write_tx2gene(gtf_filename: str, output_filename: str) -> None:
+    # transcript to gene table of every transcript in the GTF, streamed
+    tx2gene = {}
+    opener = gzip.open if gtf_filename.endswith(".gz") else open
+    with opener(gtf_filename, "rt") as f:
+        for line in f:
+            fields = line.split("\t")
+            if line.startswith("#") or len(fields) < 9:
+                continue
+            transcript = re.search(r'transcript_id "([^"]+)"', fields[8])
+            gene = re.search(r'gene_id "([^"]+)"', fields[8])
+            if transcript is not None and gene is not None:
+                tx2gene[transcript.group(1)] = gene.group(1)
+    with open(output_filename, "w") as f:
+        for transcript, gene in tx2gene.items():
+            f.write(f"{transcript}\t{gene}\n")
+
+
+def build_transcriptome_index(aligner: str, fasta_filename: str, n_cores: int, output_filename: str) -> None:
+    # index the transcriptome for salmon (a directory) or kallisto (a file)
+    if aligner == "salmon":
+        command = f"salmon index -t {fasta_filename} -i {output_filename} -p {n_cores}"
+    elif aligner == "kallisto":
+        command = f"kallisto index -i {output_filename} {fasta_filename}"
+    else:
+        raise ValueError(f"Unknown pseudo-aligner {aligner}, choose from {list(PSEUDO_QUANT_FILES)}")
+    logger.info(f"Running `{command}`...")
+    if subprocess.Popen(command, shell=True).wait() != 0:
+        raise ValueError(f"{aligner} indexing failed for {fasta_filename}")
+
+
+def build_star_index(fasta_filename: str, gtf_filename: str, n_cores: int, output_directory: str) -> None:
+    # generate a STAR genome with splice junctions from the annotation
+    os.makedirs(output_directory, exist_ok=True)
+    command = f"STAR --runMode genomeGenerate --runThreadN {n_cores} --genomeDir {output_directory} --genomeFastaFiles {fasta_filename} --sjdbGTFfile {gtf_filename} --outFileNamePrefix {output_directory}/"
+    logger.info(f"Running `{command}`...")
+    if subprocess.Popen(command, shell=True).wait() != 0:
+        raise ValueError(f"STAR genome generation failed for {fasta_filename} and {gtf_filename}")
+
+
+def prepare_references(configs: Dict) -> Dict:
+    # build every derived reference asset once per checksum and point the run at the cached copies
+    cache_directory = configs["reference_cache_directory"]
+    os.makedirs(cache_directory, exist_ok=True)
+    new_configs = {}
+    # STAR index from the genome and annotation when both are given and BAMs are made
+    pseudo = configs["quantification_mode"] == "pseudo"
+    if not pseudo and configs["reference_fasta"] is not None and configs["reference_gtf"] is not None:
+        fasta_key = checksum(filename=configs["reference_fasta"], cache_directory=cache_directory)
+        gtf_key = checksum(filename=configs["reference_gtf"], cache_directory=cache_directory)
+        new_configs["reference_genome"] = cached_asset(
+            cache_directory=cache_directory,
+            key=combine_keys([fasta_key, gtf_key]),
+            name="star_index",
+            build=lambda output_directory: build_star_index(
+                fasta_filename=configs["reference_fasta"],
+                gtf_filename=configs["reference_gtf"],
+                n_cores=int(configs["n_cores"]),
+                output_directory=output_directory,
+            ),
+        )
+    # exon union lengths of every gene for length normalization
+    if configs["reference_gtf"] is not None:
+        new_configs["gene_lengths_filename"] = cached_asset(
+            cache_directory=cache_directory,
+            key=checksum(filename=configs["reference_gtf"], cache_directory=cache_directory),
+            name="gene_lengths.tsv",
+            build=lambda output_filename: write_gene_lengths(
+                gtf_filename=configs["reference_gtf"], output_filename=output_filename
+            ),
+        )
+    # transcriptome index and transcript to gene table for pseudo-alignment
+    if pseudo and configs["transcriptome_index"] is None and configs["transcriptome_fasta"] is not None:
+        aligner = configs["pseudo_aligner"]
+        new_configs["transcriptome_index"] = cached_asset(
+            cache_directory=cache_directory,
+            key=combine_keys(
+                [checksum(filename=configs["transcriptome_fasta"], cache_directory=cache_directory), aligner]
+            ),
+            name=f"{aligner}_index",
+            build=lambda output_filename: build_transcriptome_index(
+                aligner=aligner,
+                fasta_filename=configs["transcriptome_fasta"],
+                n_cores=int(configs["n_cores"]),
+                output_filename=output_filename,
+            ),
+        )
+    if pseudo and configs["tx2gene_filename"] is None and configs["reference_gtf"] is not None:
+        new_configs["tx2gene_filename"] = cached_asset(
+            cache_directory=cache_directory,
+            key=checksum(filename=configs["reference_gtf"], cache_directory=cache_directory),
+            name="tx2gene.tsv",
+            build=lambda output_filename: write_tx2gene(
+                gtf_filename=configs["reference_gtf"], output_filename=output_filename
+            ),
+        )
+    # the remaining assets serve BAM QC, which the pseudo mode skips
+    if pseudo:
+        logger.info(f"References prepared from {cache_directory}: {new_configs}")
+        return new_configs
+    # sorted gene BED read by every RSeQC tool
+    bed_key = checksum(filename=configs["bam_qc_reference"], cache_directory=cache_directory)
+    new_configs["bam_qc_reference"] = cached_asset(
+        cache_directory=cache_directory,
+        key=bed_key,
+        name="genes.sorted.bed",
+        build=lambda output_filename: write_sorted_bed(
+            bed_filename=configs["bam_qc_reference"], output_filename=output_filename
+        ),
+    )
+    # downsampled BED for gene body coverage unless one was given
+    if configs["bam_qc_reference_downsampled"] is None:
+        keys = [bed_key, str(configs["reference_downsample_n_genes"])]
+        if configs["housekeeping_genes_filename"] is not None:
+            keys.append(
+                checksum(filename=configs["housekeeping_genes_filename"], cache_directory=cache_directory)
+            )
+        else:
+            keys.append(hashlib.sha1("\n".join(HOUSEKEEPING_GENES).encode()).hexdigest())
+        if configs["reference_gtf"] is not None:
+            keys.append(checksum(filename=configs["reference_gtf"], cache_directory=cache_directory))
+        new_configs["bam_qc_reference_downsampled"] = cached_asset(
+            cache_directory=cache_directory,
+            key=combine_keys(keys),
+            name="genes.downsampled.bed",
+            build=lambda output_filename: write_downsampled_bed(
+                sorted_bed_filename=new_configs["bam_qc_reference"],
+                output_filename=output_filename,
+                n_genes=configs["reference_downsample_n_genes"],
+                housekeeping_filename=configs["housekeeping_genes_filename"],
+                gtf_filename=configs["reference_gtf"],
+            ),
+        )
+    logger.info(f"References prepared from {cache_directory}: {new_configs}")
+    return new_configs
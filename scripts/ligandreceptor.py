@@ -1,13 +1,22 @@
 import argparse
 import logging
 import os
+import numpy as np
 import pandas as pd
-from typing import Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 
 # create a logger object writing to the given file
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# target size in bytes of a single block of paracrine scores, roughly an L2 cache
+BLOCK_BYTES = 2 * 1024 ** 2
+# target size in bytes of the null scores computed by a single permutation batch
+PERMUTATION_BATCH_BYTES = 64 * 1024 ** 2
+# per-process state shared with the paracrine and permutation workers
+_WORKER_STATE = {}
+
 def retrieve_cellphonedb(cellphonedb_directory: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.Series]:
     logger.info(f"Reading in CellPhoneDB parameters from {cellphonedb_directory}")
     # read in cellphonedb
@@ -55,25 +64,147 @@ def calculate_expression(df_gene: pd.DataFrame, df_complex: pd.DataFrame, df: pd
     p2g.update(c2gns)
     return df_profile, p2g
 
+def build_partner_matrices(df_intrxn: pd.DataFrame, df_profile: pd.DataFrame, p2g: Dict) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    # only keep interactions where both partners have a profile
+    mask = df_intrxn['multidata_1_id'].isin(df_profile.columns) & df_intrxn['multidata_2_id'].isin(df_profile.columns)
+    df_intrxn = df_intrxn.loc[mask]
+    # convert ids to human readable names
+    names = [p2g[int(a1)]+':'+p2g[int(a2)] for a1, a2 in zip(df_intrxn['multidata_1_id'], df_intrxn['multidata_2_id'])]
+    # align each partner into a (samples x interactions) matrix
+    partner_1 = df_profile[df_intrxn['multidata_1_id']].to_numpy(dtype=float)
+    partner_2 = df_profile[df_intrxn['multidata_2_id']].to_numpy(dtype=float)
+    return names, partner_1, partner_2
+
 def score_interactions(df_intrxn: pd.DataFrame, df_profile: pd.DataFrame, p2g: Dict) -> pd.DataFrame:
     # compute associations between each ligand-receptor pair
-    scores = []
-    for idx in df_intrxn.index:
-        a1, a2 = df_intrxn.loc[idx, ['multidata_1_id','multidata_2_id']]
-        if a1 not in df_profile.columns or a2 not in df_profile.columns: continue
-        score = df_profile[a1] * df_profile[a2]
-        score.name = f'{idx}:{a1}<>{a2}'
-        scores.append(score)
-    df_scores = pd.concat(scores, axis=1).T
-    # convert ids to human readable names
-    ids = df_scores.index.to_series().str.split(':', expand=True)[1].str.split('<>', expand=True)
-    ids = [p2g[int(i1)]+':'+p2g[int(i2)] for i1, i2 in zip(ids[0], ids[1])]
-    df_scores.index = ids
+    names, partner_1, partner_2 = build_partner_matrices(df_intrxn=df_intrxn, df_profile=df_profile, p2g=p2g)
+    df_scores = pd.DataFrame((partner_1 * partner_2).T, index=names, columns=df_profile.index)
     return df_scores
 
+def read_groups(groups_file: str, samples: pd.Index) -> pd.Series:
+    logger.info(f"Reading in sample groups from {groups_file}")
+    # read in the sample to group mapping, i.e. the first column is the sample and the second the group
+    groups = pd.read_csv(groups_file, index_col=0).iloc[:, 0]
+    missing = samples.difference(groups.index)
+    if len(missing) > 0:
+        raise ValueError(f"There are {len(missing)} samples without a group in {groups_file}, e.g. {missing[0]}")
+    return groups.loc[samples]
+
+def aggregate_groups(df_profile: pd.DataFrame, groups: pd.Series) -> pd.DataFrame:
+    # average the sample profiles within each group
+    return df_profile.groupby(groups.values).mean()
+
+def _init_permutation_worker(partner_1: np.ndarray, partner_2: np.ndarray, codes: np.ndarray, observed: np.ndarray) -> None:
+    # share the aligned matrices with each worker once instead of per batch
+    _WORKER_STATE.update(partner_1=partner_1, partner_2=partner_2, codes=codes, observed=observed)
+
+def _count_permutation_batch(task: Tuple[np.random.SeedSequence, int]) -> np.ndarray:
+    seed, n_permutations = task
+    rng = np.random.default_rng(seed)
+    partner_1, partner_2, codes, observed = (_WORKER_STATE[k] for k in ['partner_1', 'partner_2', 'codes', 'observed'])
+    if codes is None:
+        # shuffle which sample each receptor profile is paired with, shaped (permutations, samples, interactions)
+        perms = rng.permuted(np.tile(np.arange(partner_1.shape[0]), (n_permutations, 1)), axis=1)
+        null = partner_1[None, :, :] * partner_2[perms]
+    else:
+        # shuffle the group labels of the samples and recompute every group mean at once
+        perms = rng.permuted(np.tile(codes, (n_permutations, 1)), axis=1)
+        membership = (perms[:, None, :] == np.arange(observed.shape[0])[None, :, None]).astype(float)
+        membership /= membership.sum(axis=-1, keepdims=True)
+        null = (membership @ partner_1) * (membership @ partner_2)
+    # count how often the null is at least as extreme as the observed score
+    return (null >= observed[None]).sum(axis=0)
+
+def permutation_test(partner_1: np.ndarray, partner_2: np.ndarray, codes: np.ndarray = None, n_permutations: int = 1000, n_cores: int = 1, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    # compute the observed scores from the precomputed (samples x interactions) partner matrices
+    if codes is None:
+        observed = partner_1 * partner_2
+        bytes_per_permutation = 8 * 2 * observed.size
+    else:
+        membership = (codes[None, :] == np.arange(codes.max() + 1)[:, None]).astype(float)
+        membership /= membership.sum(axis=-1, keepdims=True)
+        observed = (membership @ partner_1) * (membership @ partner_2)
+        bytes_per_permutation = 8 * (membership.size + 3 * observed.size)
+    # size each batch of permutations so its null scores fit in the memory budget
+    batch_size = max(1, min(n_permutations, PERMUTATION_BATCH_BYTES // bytes_per_permutation))
+    batches = [min(batch_size, n_permutations - start) for start in range(0, n_permutations, batch_size)]
+    # spawn one independent stream per batch so results do not depend on the number of cores
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    logger.info(f"Running {n_permutations} permutations in {len(batches)} batches of {batch_size} with {n_cores} cores")
+    counts = np.zeros(observed.shape, dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=n_cores, initializer=_init_permutation_worker, initargs=(partner_1, partner_2, codes, observed)) as executor:
+        for batch_counts in executor.map(_count_permutation_batch, zip(seeds, batches)):
+            counts += batch_counts
+    # empirical p-values with the observed score counted as one permutation
+    pvalues = (counts + 1) / (n_permutations + 1)
+    return observed, pvalues
+
+def benjamini_hochberg(pvalues: np.ndarray) -> np.ndarray:
+    # adjust all p-values jointly for the false discovery rate
+    flat = pvalues.ravel()
+    order = np.argsort(flat)
+    adjusted = flat[order] * len(flat) / np.arange(1, len(flat) + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    fdr = np.empty_like(flat)
+    fdr[order] = np.minimum(adjusted, 1)
+    return fdr.reshape(pvalues.shape)
+
+def derive_block_size(n_interactions: int, block_bytes: int = BLOCK_BYTES) -> int:
+    # choose the number of senders (and receivers) so a block of float64 scores fits in cache
+    return max(1, int(np.sqrt(block_bytes / (8 * max(n_interactions, 1)))))
+
+def _init_paracrine_worker(names: List[str], labels: List[str], partner_1: np.ndarray, partner_2: np.ndarray, output_directory: str, top_k: int) -> None:
+    # share the aligned matrices with each worker once instead of per block
+    _WORKER_STATE.update(names=np.asarray(names), labels=np.asarray(labels), partner_1=partner_1, partner_2=partner_2, output_directory=output_directory, top_k=top_k)
+
+def _score_paracrine_block(block: Tuple[int, int, int, int]) -> str:
+    sender_start, sender_end, receiver_start, receiver_end = block
+    names, labels = _WORKER_STATE['names'], _WORKER_STATE['labels']
+    # ligand(sender) x receptor(receiver) for every interaction, shaped (senders, receivers, interactions)
+    scores = _WORKER_STATE['partner_1'][sender_start:sender_end, None, :] * _WORKER_STATE['partner_2'][None, receiver_start:receiver_end, :]
+    n_senders, n_receivers, n_interactions = scores.shape
+    idxs = np.broadcast_to(np.arange(n_interactions), scores.shape)
+    # only keep the strongest interactions for each sender-receiver pair
+    top_k = _WORKER_STATE['top_k']
+    if top_k and top_k < n_interactions:
+        idxs = np.argpartition(-scores, top_k - 1, axis=-1)[..., :top_k]
+        scores = np.take_along_axis(scores, idxs, axis=-1)
+    n_kept = scores.shape[-1]
+    df_block = pd.DataFrame({
+        'sender': np.repeat(labels[sender_start:sender_end], n_receivers * n_kept),
+        'receiver': np.tile(np.repeat(labels[receiver_start:receiver_end], n_kept), n_senders),
+        'interaction': names[idxs.ravel()],
+        'score': scores.ravel(),
+    })
+    # write the block to its own chunk so nothing is held beyond a single block
+    filename = os.path.join(_WORKER_STATE['output_directory'], f'block_{sender_start:06d}_{receiver_start:06d}.csv.gz')
+    df_block.to_csv(filename, index=False)
+    return filename
+
+def score_paracrine_interactions(df_intrxn: pd.DataFrame, df_profile: pd.DataFrame, p2g: Dict, output_directory: str, n_cores: int = 1, block_size: int = 0, top_k: int = 0) -> List[str]:
+    # compute associations between each ligand (sender) and receptor (receiver) pair
+    names, partner_1, partner_2 = build_partner_matrices(df_intrxn=df_intrxn, df_profile=df_profile, p2g=p2g)
+    labels = df_profile.index.astype(str).tolist()
+    if block_size <= 0:
+        block_size = derive_block_size(n_interactions=len(names))
+    # tile the sender x receiver space into blocks
+    blocks = [
+        (s, min(s + block_size, len(labels)), r, min(r + block_size, len(labels)))
+        for s in range(0, len(labels), block_size)
+        for r in range(0, len(labels), block_size)
+    ]
+    logger.info(f"Scoring {len(names)} paracrine interactions across {len(labels)}x{len(labels)} pairs in {len(blocks)} blocks of {block_size} with {n_cores} cores")
+    os.makedirs(output_directory, exist_ok=True)
+    filenames = []
+    with ProcessPoolExecutor(max_workers=n_cores, initializer=_init_paracrine_worker, initargs=(names, labels, partner_1, partner_2, output_directory, top_k)) as executor:
+        for filename in executor.map(_score_paracrine_block, blocks):
+            filenames.append(filename)
+    logger.info(f"Paracrine scores written to {output_directory} in {len(filenames)} chunks")
+    return filenames
+
 def main():
     # read in command line arguments
-    parser = argparse.ArgumentParser(description="CellPhoneDB Autocrine Signaling Quantification")
+    parser = argparse.ArgumentParser(description="CellPhoneDB Autocrine and Paracrine Signaling Quantification")
     parser.add_argument(
         "-c",
         "--cellphone_db",
@@ -93,7 +224,7 @@ def main():
         "--output_file",
         type=str,
         default="/home/dchen2/TMP/expr.ligandreceptor.csv",
-        help="Path to the output ligand-receptor matrix",
+        help="Path to the output ligand-receptor matrix, or the directory of chunks in paracrine mode",
     )
     parser.add_argument(
         "-t",
@@ -102,6 +233,56 @@ def main():
         default=False,
         help="Whether to transpose the expression matrix, i.e. if it is rows are columns and genes are samples"
     )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        type=str,
+        default="autocrine",
+        choices=["autocrine", "paracrine"],
+        help="Score ligand and receptor within the same sample (autocrine) or across every sender-receiver pair (paracrine)",
+    )
+    parser.add_argument(
+        "-g",
+        "--groups_file",
+        type=str,
+        default=None,
+        help="Optional CSV mapping samples (first column) to groups (second column), profiles are averaged per group before scoring",
+    )
+    parser.add_argument(
+        "-n",
+        "--n_cores",
+        type=int,
+        default=1,
+        help="Number of cores to utilize for paracrine scoring",
+    )
+    parser.add_argument(
+        "-b",
+        "--block_size",
+        type=int,
+        default=0,
+        help="Number of senders (and receivers) per paracrine block, 0 picks a cache-sized block automatically",
+    )
+    parser.add_argument(
+        "-k",
+        "--top_k",
+        type=int,
+        default=0,
+        help="Only keep the top K interactions per sender-receiver pair in paracrine mode, 0 keeps all",
+    )
+    parser.add_argument(
+        "-p",
+        "--n_permutations",
+        type=int,
+        default=0,
+        help="Number of sample (or group) label permutations for empirical p-values in autocrine mode, 0 skips the test",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed for the permutation test",
+    )
     args = parser.parse_args()
 
     # gather raw database information
@@ -117,6 +298,18 @@ def main():
 
     # calculate expression of each gene and complex
     df_profile, p2g = calculate_expression(df_gene=df_gene, df_complex=df_complex, df=df.T)
+    groups = None
+    if args.groups_file is not None:
+        groups = read_groups(groups_file=args.groups_file, samples=df_profile.index)
+        df_sample_profile = df_profile
+        df_profile = aggregate_groups(df_profile=df_profile, groups=groups)
+
+    # score all ligand-receptor interactions (paracrine manner) streaming blocks to disk
+    if args.mode == "paracrine":
+        if args.n_permutations > 0:
+            raise ValueError("The permutation test is only supported for autocrine scores")
+        score_paracrine_interactions(df_intrxn=df_intrxn, df_profile=df_profile, p2g=p2g, output_directory=args.output_file, n_cores=args.n_cores, block_size=args.block_size, top_k=args.top_k)
+        return
 
     # score all ligand-receptor interactions (autocrine manner)
     df_scores = score_interactions(df_intrxn=df_intrxn, df_profile=df_profile, p2g=p2g)
@@ -126,6 +319,20 @@ def main():
     os.makedirs(directory, exist_ok=True)
     df_scores.to_csv(args.output_file)
 
+    # test the scores against shuffled sample (or group) labels
+    if args.n_permutations > 0:
+        codes = None
+        if groups is not None:
+            codes = pd.Categorical(groups.values, categories=df_profile.index).codes
+            df_profile = df_sample_profile
+        _, partner_1, partner_2 = build_partner_matrices(df_intrxn=df_intrxn, df_profile=df_profile, p2g=p2g)
+        _, pvalues = permutation_test(partner_1=partner_1, partner_2=partner_2, codes=codes, n_permutations=args.n_permutations, n_cores=args.n_cores, seed=args.seed)
+        fdr = benjamini_hochberg(pvalues=pvalues)
+        # write the p-values and fdr next to the scores in the same layout
+        prefix = os.path.splitext(args.output_file)[0]
+        pd.DataFrame(pvalues.T, index=df_scores.index, columns=df_scores.columns).to_csv(f"{prefix}.pvalues.csv")
+        pd.DataFrame(fdr.T, index=df_scores.index, columns=df_scores.columns).to_csv(f"{prefix}.fdr.csv")
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,16 @@
 import argparse
-import datetime
+import ast
+import csv
+import hashlib
 import logging
 import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import loompy
+import numpy as np
 import pandas as pd
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
 # create a logger object writing to the given file
 logger = logging.getLogger(__name__)
@@ -11,71 +18,206 @@ logger.setLevel(logging.INFO)
 
 # create constants for database locations
 TF_DB = "/fh/fast/greenberg_p/user/dchen2/SAUCE/resources/pyscenic_data/allTFs_hg38.txt"
-FEATHER_PT = "/fh/fast/greenberg_p/user/dchen2/SAUCE/resources/pyscenic_data/*.feather"
+FEATHER_PAT = "/fh/fast/greenberg_p/user/dchen2/SAUCE/resources/pyscenic_data/*.feather"
 ANNO_FN = "/fh/fast/greenberg_p/user/dchen2/SAUCE/resources/pyscenic_data/motifs-v10nr_clust-nr.hgnc-m0.001-o0.0.tbl"
-TIMESTAMP = round(datetime.datetime.now().timestamp())
+# prefix for outputs that are still being written
+PARTIAL_PREFIX = ".partial."
 
-def construct_filenames(output_directory: str, timestamp: int) -> Tuple[str, str, str, str]:
-    expr_mtx = os.path.join(output_directory, f"{timestamp}.expr.csv")
-    adj_fn = os.path.join(output_directory, f"{timestamp}.adj.csv")
-    reg_fn = os.path.join(output_directory, f"{timestamp}.reg.csv")
-    out_fn = os.path.join(output_directory, f"{timestamp}.pyscenic.csv")
+def hash_file(filename: str) -> str:
+    # hash the contents of a file in chunks
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def stat_file(filename: str) -> str:
+    # cheap fingerprint for large databases that are not edited in place
+    stat = os.stat(filename)
+    return f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def fingerprint(*parts) -> str:
+    # combine the inputs of a stage into a short key
+    return hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()[:16]
+
+def construct_filenames(output_directory: str, keys: Tuple[str, str, str, str]) -> Tuple[str, str, str, str]:
+    expr_key, adj_key, reg_key, out_key = keys
+    expr_mtx = os.path.join(output_directory, f"{expr_key}.expr.loom")
+    adj_fn = os.path.join(output_directory, f"{adj_key}.adj.tsv")
+    reg_fn = os.path.join(output_directory, f"{reg_key}.reg.csv")
+    out_fn = os.path.join(output_directory, f"{out_key}.pyscenic.csv")
     return expr_mtx, adj_fn, reg_fn, out_fn
 
-def validate_filenames(filenames: Tuple[str, str, str, str]) -> bool:
-    any_exist = False
-    for filename in filenames:
-        if os.path.exists(filename):
-            any_exist = True
-            break
-    return any_exist
-    
-def validate_timestamp(output_directory: str, timestamp: int) -> Tuple[str, int]:
-    logger.info(f"Identifying a valid timestamp to utilize for file names starting from {timestamp}...")
-    # continously find a timestamp that works best
-    filenames = construct_filenames(output_directory=output_directory, timestamp=timestamp)
-    # instantiate tracker t
-    n_tries = 0
-    while os.path.exists(validate_filenames(filenames=filenames)):
-        # reconstruct the filenames based on the new stamp
-        timestamp += 1
-        filenames = construct_filenames(output_directory=output_directory, timestamp=timestamp)
-        # upcount the number of tries, break after five tries
-        n_tries += 1
-        if n_tries >= 5:
-            break
-    if os.path.exists(adj_fn):
-        raise ValueError("Temporary filename cannot be found")
-    logger.info(f"Valid timestamp {timestamp} has been found.")
-    return timestamp
+def construct_seed_filenames(output_directory: str, expr_key: str, seeds: List[int], tf_db: str = TF_DB) -> List[str]:
+    # each seed is its own cached stage so a partially finished ensemble can resume
+    return [os.path.join(output_directory, f"{fingerprint(expr_key, stat_file(tf_db), f'seed={seed}')}.adj.tsv") for seed in seeds]
+
+def construct_keys(expression_file: str, transpose: bool, min_expression: float, min_samples: int, n_seeds: int = 1, min_edge_frequency: float = 0, aucell_backend: str = "native", auc_threshold: float = 0.05, tf_db: str = TF_DB, feather_pat: str = FEATHER_PAT, anno_fn: str = ANNO_FN) -> Tuple[str, str, str, str]:
+    logger.info(f"Fingerprinting inputs from {expression_file}...")
+    # each stage is keyed on its own parameters and the key of the stage before it
+    expr_key = fingerprint(hash_file(expression_file), transpose, min_expression, min_samples)
+    adj_key = fingerprint(expr_key, stat_file(tf_db), "seed=0")
+    if n_seeds > 1:
+        adj_key = fingerprint(expr_key, stat_file(tf_db), f"seeds={n_seeds}", min_edge_frequency)
+    reg_key = fingerprint(adj_key, *[stat_file(fn) for fn in sorted(glob(feather_pat))], stat_file(anno_fn), "mask_dropouts")
+    out_key = fingerprint(reg_key, "aucell", aucell_backend, auc_threshold)
+    return expr_key, adj_key, reg_key, out_key
+
+def partial_filename(filename: str) -> str:
+    # keep the extension so tools still infer the output format
+    return os.path.join(os.path.dirname(filename), PARTIAL_PREFIX + os.path.basename(filename))
 
 def run(command: str) -> subprocess.Popen:
     # run a command in the shell and return the process
     logger.info(f"Running `{command}`...")
     process = subprocess.Popen(command, shell=True)
     return process
-    
-def run_arboreto_mp(expr_mtx: str, out_fn: str, tf_db: str = TF_DB, n_cores: int = 1):
-    logger.info(f"Running arboreto with multiprocessing enabled {n_cores} cores to find co-expression modules...")
-    process = run(f"python arboreto_with_multiprocessing.py {expr_mtx} {tf_db} -o {out_fn} --num_workers {n_cores} --seed 0")
-    process.wait()
-    logger.info("arboreto has finished running.")
+
+def run_stage(command: str, out_fn: str) -> None:
+    # run the command against a partial output and only publish it on success
+    process = run(command)
+    if process.wait() != 0:
+        raise ValueError(f"Command exited with status {process.returncode}: {command}")
+    os.replace(partial_filename(out_fn), out_fn)
+
+def filter_genes(expr_mtx_data: pd.DataFrame, min_expression: float = 0, min_samples: int = 0) -> pd.DataFrame:
+    # only keep genes expressed above the threshold in enough samples
+    mask = (expr_mtx_data >= min_expression).sum(axis=0) >= min_samples
+    logger.info(f"Keeping {mask.sum()} of {len(mask)} genes expressed >= {min_expression} in >= {min_samples} samples")
+    return expr_mtx_data.loc[:, mask]
+
+def write_expression_matrix(expr_mtx_data: pd.DataFrame, expr_mtx: str) -> None:
+    logger.info(f"Writing expression matrix of {expr_mtx_data.shape[0]} samples and {expr_mtx_data.shape[1]} genes to {expr_mtx}")
+    # loom stores genes as rows and samples as columns
+    loompy.create(
+        partial_filename(expr_mtx),
+        expr_mtx_data.T.to_numpy(dtype=np.float32),
+        row_attrs={"Gene": np.array(expr_mtx_data.columns, dtype=str)},
+        col_attrs={"CellID": np.array(expr_mtx_data.index, dtype=str)},
+    )
+    os.replace(partial_filename(expr_mtx), expr_mtx)
+
+def read_expression_matrix(expr_mtx: str) -> pd.DataFrame:
+    # read the loom back into a (samples x genes) dataframe
+    with loompy.connect(expr_mtx, mode="r") as ds:
+        return pd.DataFrame(ds[:, :].T, index=ds.ca.CellID, columns=ds.ra.Gene)
+
+def load_regulons(reg_fn: str, use_weights: bool = False) -> Dict[str, Dict[str, float]]:
+    logger.info(f"Reading in regulons from the enriched motifs in {reg_fn}")
+    # read in the motif enrichment table written by pyscenic ctx
+    df_motifs = pd.read_csv(reg_fn, index_col=[0, 1], header=[0, 1], skipinitialspace=True)
+    contexts = df_motifs[("Enrichment", "Context")].astype(str)
+    targets = df_motifs[("Enrichment", "TargetGenes")].apply(ast.literal_eval)
+    # merge the targets of every motif into a regulon per TF and direction, keeping the strongest weight
+    regulons = {}
+    for (tf, _), context, gene2weight in zip(df_motifs.index, contexts, targets):
+        name = f"{tf}(-)" if "repressing" in context else f"{tf}(+)"
+        regulon = regulons.setdefault(name, {})
+        for gene, weight in gene2weight:
+            regulon[gene] = max(regulon.get(gene, 0), weight if use_weights else 1.0)
+    return regulons
+
+def create_rankings(expr_mtx_data: pd.DataFrame, seed: int = None) -> np.ndarray:
+    # shuffle genes first so ties are broken at random, as pyscenic does
+    rng = np.random.default_rng(seed)
+    shuffle = rng.permutation(expr_mtx_data.shape[1])
+    values = expr_mtx_data.to_numpy(dtype=np.float64)[:, shuffle]
+    # rank genes per sample from highest (0) to lowest expression
+    order = np.argsort(-values, axis=1, kind="stable")
+    rankings = np.empty(values.shape, dtype=np.int32)
+    rankings[np.arange(values.shape[0])[:, None], shuffle[order]] = np.arange(values.shape[1], dtype=np.int32)[None, :]
+    return rankings
+
+def aucell(expr_mtx_data: pd.DataFrame, regulons: Dict[str, Dict[str, float]], auc_threshold: float = 0.05, seed: int = None) -> pd.DataFrame:
+    # build the (genes x regulons) membership matrix, dropping targets missing from the expression matrix
+    genes = pd.Index(expr_mtx_data.columns)
+    names, columns = [], []
+    for name, gene2weight in regulons.items():
+        idxs = genes.get_indexer(list(gene2weight))
+        mask = idxs >= 0
+        if not mask.any():
+            continue
+        column = np.zeros(len(genes))
+        column[idxs[mask]] = np.array(list(gene2weight.values()))[mask]
+        names.append(name)
+        columns.append(column)
+    membership = np.stack(columns, axis=1)
+    logger.info(f"Scoring {len(names)} regulons across {expr_mtx_data.shape[0]} samples natively")
+    # only the genes ranked below the cutoff contribute to the recovery curve, as in ctxcore
+    rank_cutoff = int(round(auc_threshold * len(genes))) - 1
+    rankings = create_rankings(expr_mtx_data=expr_mtx_data, seed=seed)
+    # the area under each recovery curve is the weighted distance of every recovered gene to the cutoff
+    recovery = np.maximum(rank_cutoff - rankings, 0).astype(np.float64)
+    aucs = (recovery @ membership) / ((rank_cutoff + 1) * membership.sum(axis=0))
+    df_aucs = pd.DataFrame(aucs, index=expr_mtx_data.index, columns=names)
+    df_aucs.index.name = "Cell"
+    df_aucs.columns.name = "Regulon"
+    return df_aucs
+
+def run_aucell_native(expr_mtx: str, reg_fn: str, out_fn: str, auc_threshold: float = 0.05, seed: int = None):
+    logger.info("Compute TF activity via AUC of ranked gene expression in-process...")
+    df_aucs = aucell(expr_mtx_data=read_expression_matrix(expr_mtx=expr_mtx), regulons=load_regulons(reg_fn=reg_fn), auc_threshold=auc_threshold, seed=seed)
+    df_aucs.to_csv(partial_filename(out_fn))
+    os.replace(partial_filename(out_fn), out_fn)
+    logger.info("aucell has finished running.")
+
+def run_arboreto_mp(expr_mtx: str, out_fn: str, tf_db: str = TF_DB, n_cores: int = 1, seed: int = 0):
+    logger.info(f"Running arboreto with multiprocessing enabled {n_cores} cores to find co-expression modules with seed {seed}...")
+    run_stage(f"python arboreto_with_multiprocessing.py {expr_mtx} {tf_db} -o {partial_filename(out_fn)} --num_workers {n_cores} --seed {seed}", out_fn=out_fn)
+    logger.info(f"arboreto has finished running with seed {seed}.")
+
+def run_arboreto_seeds(expr_mtx: str, out_fns: List[str], seeds: List[int], tf_db: str = TF_DB, n_cores: int = 1):
+    # only run the seeds that do not have adjacencies yet
+    todo = [(out_fn, seed) for out_fn, seed in zip(out_fns, seeds) if not os.path.exists(out_fn)]
+    if len(todo) == 0:
+        return
+    # split the core budget across the concurrent seeds
+    n_concurrent = max(1, min(len(todo), n_cores))
+    n_workers = max(1, n_cores // n_concurrent)
+    logger.info(f"Running {len(todo)} arboreto seeds, {n_concurrent} at a time with {n_workers} cores each...")
+    with ThreadPoolExecutor(max_workers=n_concurrent) as executor:
+        futures = [executor.submit(run_arboreto_mp, expr_mtx=expr_mtx, out_fn=out_fn, tf_db=tf_db, n_cores=n_workers, seed=seed) for out_fn, seed in todo]
+        for future in futures:
+            future.result()
+
+def merge_adjacencies(adj_fns: List[str], out_fn: str, min_edge_frequency: float = 0):
+    logger.info(f"Merging {len(adj_fns)} adjacency tables into a consensus...")
+    # stream one table at a time, only keeping a running count and importance sum per edge
+    edges = {}
+    for adj_fn in adj_fns:
+        with open(adj_fn, "r") as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                edge = edges.setdefault((row["TF"], row["target"]), [0, 0.0])
+                edge[0] += 1
+                edge[1] += float(row["importance"])
+    # average the importance over every seed, so edges missing from a seed count as zero
+    n_seeds = len(adj_fns)
+    consensus = [
+        (tf, target, total / n_seeds, count / n_seeds)
+        for (tf, target), (count, total) in edges.items()
+        if count / n_seeds >= min_edge_frequency
+    ]
+    consensus.sort(key=lambda edge: edge[2], reverse=True)
+    with open(partial_filename(out_fn), "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["TF", "target", "importance", "frequency"])
+        writer.writerows(consensus)
+    os.replace(partial_filename(out_fn), out_fn)
+    logger.info(f"Consensus of {len(consensus)} of {len(edges)} edges written to {out_fn}")
 
 def run_tx_corr(expr_mtx: str, adj_fn: str, out_fn: str, feather_pat: str = FEATHER_PAT, anno_fn: str = ANNO_FN, n_cores: int = 1):
     logger.info(f"Infer motifs enriched in putative regulatory regions of GRNs with {n_cores} cores...")
-    process = run(f"pyscenic ctx {adj_fn} {feather_pat} --annotations_fname {anno_fn} --expression_mtx_fname {expr_mtx} --output {out_fn} --mask_dropouts --num_workers {n_cores}")
-    process.wait()
+    run_stage(f"pyscenic ctx {adj_fn} {feather_pat} --annotations_fname {anno_fn} --expression_mtx_fname {expr_mtx} --output {partial_filename(out_fn)} --mask_dropouts --num_workers {n_cores}", out_fn=out_fn)
     logger.info("ctx has finished running.")
 
-def run_aucell(expr_mtx: str, reg_fn: str, out_fn: str):
-    logger.info(f"Compute TF activity via AUC of ranked gene expression...")
-    process = run(f"pyscenic aucell {expr_mtx} {reg_fn} --output {out_fn} --num_workers {n_cores}")
-    process.wait()
+def run_aucell(expr_mtx: str, reg_fn: str, out_fn: str, auc_threshold: float = 0.05, n_cores: int = 1):
+    logger.info("Compute TF activity via AUC of ranked gene expression...")
+    run_stage(f"pyscenic aucell {expr_mtx} {reg_fn} --output {partial_filename(out_fn)} --auc_threshold {auc_threshold} --num_workers {n_cores}", out_fn=out_fn)
     logger.info("aucell has finished running.")
 
 def main():
     # read in command line arguments
-    parser = argparse.ArgumentParser(description="CellPhoneDB Autocrine Signaling Quantification")
+    parser = argparse.ArgumentParser(description="pySCENIC Gene Regulatory Network and Regulon Activity Inference")
     parser.add_argument(
         "-d",
         "--expression_file",
@@ -104,23 +246,84 @@ def main():
         default=False,
         help="Whether to transpose the expression matrix, i.e. if it is rows are genes and columns are samples"
     )
+    parser.add_argument(
+        "-e",
+        "--min_expression",
+        type=float,
+        default=0,
+        help="Expression a gene must reach in --min_samples samples to be kept for GRN inference",
+    )
+    parser.add_argument(
+        "-s",
+        "--min_samples",
+        type=int,
+        default=0,
+        help="Number of samples a gene must be expressed in to be kept for GRN inference, 0 keeps all genes",
+    )
+    parser.add_argument(
+        "-a",
+        "--aucell_backend",
+        type=str,
+        default="native",
+        choices=["native", "cli"],
+        help="Score regulons in-process with NumPy (native) or through the pyscenic aucell command (cli)",
+    )
+    parser.add_argument(
+        "--auc_threshold",
+        type=float,
+        default=0.05,
+        help="Fraction of the ranked genome used to compute each regulon AUC",
+    )
+    parser.add_argument(
+        "--n_seeds",
+        type=int,
+        default=1,
+        help="Number of arboreto seeds to run concurrently and merge into consensus adjacencies",
+    )
+    parser.add_argument(
+        "--min_edge_frequency",
+        type=float,
+        default=0,
+        help="Fraction of seeds an edge must appear in to be kept in the consensus adjacencies",
+    )
     args = parser.parse_args()
 
-    # create the output directory if it does not already exist and find an appropriate timestamp
+    # create the output directory if it does not already exist and key every stage on its inputs
     os.makedirs(args.output_directory, exist_ok=True)
-    timestamp = validate_timestamp(output_directory=args.output_directory, timestamp=timestamp)
-    expr_mtx, adj_fn, reg_fn, out_fn = construct_filenames(output_directory=args.output_directory, timestamp=timestamp)
-    
+    keys = construct_keys(expression_file=args.expression_file, transpose=args.transpose, min_expression=args.min_expression, min_samples=args.min_samples, n_seeds=args.n_seeds, min_edge_frequency=args.min_edge_frequency, aucell_backend=args.aucell_backend, auc_threshold=args.auc_threshold)
+    expr_mtx, adj_fn, reg_fn, out_fn = construct_filenames(output_directory=args.output_directory, keys=keys)
+
     # write down the expression matrix
-    expr_mtx_data = pd.read_csv(args.expression_file, index_col=0)
-    if args.transpose: expr_mtx_data = expr_mtx_data.T
-    expr_mtx_data.to_csv(expr_mtx)
-
-    # sprint through the pipeline
-    run_arboreto_mp(expr_mtx=expr_mtx, out_fn=adj_fn, n_cores=args.n_cores):
-    run_tx_corr(expr_mtx=expr_mtx, adj_fn=adj_fn, out_fn=reg_fn, n_cores=args.n_cores)
-    run_aucell(expr_mtx=expr_mtx, reg_fn=reg_fn, out_fn=out_fn)
-    
-    
+    if os.path.exists(expr_mtx):
+        logger.info(f"Reusing expression matrix {expr_mtx}")
+    else:
+        expr_mtx_data = pd.read_csv(args.expression_file, index_col=0)
+        if args.transpose: expr_mtx_data = expr_mtx_data.T
+        expr_mtx_data = filter_genes(expr_mtx_data=expr_mtx_data, min_expression=args.min_expression, min_samples=args.min_samples)
+        write_expression_matrix(expr_mtx_data=expr_mtx_data, expr_mtx=expr_mtx)
+
+    # sprint through the pipeline, resuming from the first stage without an output
+    if os.path.exists(adj_fn):
+        logger.info(f"Reusing adjacencies {adj_fn}")
+    elif args.n_seeds > 1:
+        seeds = list(range(args.n_seeds))
+        seed_fns = construct_seed_filenames(output_directory=args.output_directory, expr_key=keys[0], seeds=seeds)
+        run_arboreto_seeds(expr_mtx=expr_mtx, out_fns=seed_fns, seeds=seeds, n_cores=args.n_cores)
+        merge_adjacencies(adj_fns=seed_fns, out_fn=adj_fn, min_edge_frequency=args.min_edge_frequency)
+    else:
+        run_arboreto_mp(expr_mtx=expr_mtx, out_fn=adj_fn, n_cores=args.n_cores)
+    if os.path.exists(reg_fn):
+        logger.info(f"Reusing regulons {reg_fn}")
+    else:
+        run_tx_corr(expr_mtx=expr_mtx, adj_fn=adj_fn, out_fn=reg_fn, n_cores=args.n_cores)
+    if os.path.exists(out_fn):
+        logger.info(f"Reusing regulon activities {out_fn}")
+    elif args.aucell_backend == "native":
+        run_aucell_native(expr_mtx=expr_mtx, reg_fn=reg_fn, out_fn=out_fn, auc_threshold=args.auc_threshold)
+    else:
+        run_aucell(expr_mtx=expr_mtx, reg_fn=reg_fn, out_fn=out_fn, auc_threshold=args.auc_threshold, n_cores=args.n_cores)
+    logger.info(f"pySCENIC results are available at {out_fn}")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
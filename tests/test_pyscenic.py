@@ -0,0 +1,63 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+# pyscenic.py is a standalone script rather than a package module
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+pyscenic = pytest.importorskip("pyscenic")
+recovery = pytest.importorskip("ctxcore.recovery")
+
+
+def expression_matrix(n_cells: int = 20, n_genes: int = 500, seed: int = 0) -> pd.DataFrame:
+    # counts with many zeros so ties are broken by the shared shuffle
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        rng.poisson(0.8, size=(n_cells, n_genes)).astype(float),
+        index=[f"cell{i}" for i in range(n_cells)],
+        columns=[f"gene{i}" for i in range(n_genes)],
+    )
+
+
+@pytest.mark.parametrize("auc_threshold", [0.05, 0.1, 0.33])
+@pytest.mark.parametrize("weighted", [False, True])
+def test_aucell_matches_ctxcore(auc_threshold: float, weighted: bool):
+    df = expression_matrix()
+    rng = np.random.default_rng(1)
+    regulons = {
+        f"TF{i}(+)": {
+            f"gene{j}": float(rng.uniform(0.1, 2.0)) if weighted else 1.0
+            for j in rng.choice(df.shape[1], size=rng.integers(5, 60), replace=False)
+        }
+        for i in range(8)
+    }
+    native = pyscenic.aucell(expr_mtx_data=df, regulons=regulons, auc_threshold=auc_threshold, seed=7)
+    # score the same rankings with ctxcore, as pyscenic aucell does per regulon
+    rankings = pd.DataFrame(
+        pyscenic.create_rankings(expr_mtx_data=df, seed=7), index=df.index, columns=df.columns
+    )
+    for name, gene2weight in regulons.items():
+        expected = recovery.aucs(
+            rankings[list(gene2weight)],
+            total_genes=df.shape[1],
+            weights=np.array(list(gene2weight.values())),
+            auc_threshold=auc_threshold,
+        )
+        np.testing.assert_allclose(native[name].to_numpy(), expected, rtol=1e-9, atol=1e-12)
+
+
+def test_load_regulons(tmp_path):
+    filename = tmp_path / "reg.csv"
+    filename.write_text(
+        ",,Enrichment,Enrichment\n"
+        "TF,MotifID,Context,TargetGenes\n"
+        "A,m1,\"frozenset({'activating'})\",\"[('g1', 1.0), ('g2', 0.5)]\"\n"
+        "A,m2,\"frozenset({'activating'})\",\"[('g2', 0.8)]\"\n"
+        "A,m3,\"frozenset({'repressing'})\",\"[('g3', 2.0)]\"\n"
+    )
+    assert pyscenic.load_regulons(reg_fn=str(filename)) == {"A(+)": {"g1": 1.0, "g2": 1.0}, "A(-)": {"g3": 1.0}}
+    assert pyscenic.load_regulons(reg_fn=str(filename), use_weights=True) == {
+        "A(+)": {"g1": 1.0, "g2": 0.8},
+        "A(-)": {"g3": 2.0},
+    }
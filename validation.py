@@ -0,0 +1,176 @@
+import hashlib
+import json
+import logging
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+from constants import *
+
+# create a logger object writing to the given file
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def check_records(lines: List[bytes], first_record: int) -> str:
+    # structural problem of the first malformed four line record, None when they are all well formed
+    checks = [
+        ([header[:1] == b"@" for header in lines[0::4]], "record header does not start with @"),
+        ([separator[:1] == b"+" for separator in lines[2::4]], "record separator does not start with +"),
+        ([len(s) == len(q) for s, q in zip(lines[1::4], lines[3::4])], "sequence and quality lengths differ"),
+    ]
+    for passed, error in checks:
+        if not all(passed):
+            return f"{error} at record {first_record + passed.index(False)}"
+    return None
+
+
+def validate_fastq(filename: str, chunk_size: int = VALIDATION_CHUNK_BYTES) -> Dict:
+    # checksum the compressed bytes while decompressing every gzip member and checking each record
+    stat = os.stat(filename)
+    result = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "md5": None, "records": 0, "error": None}
+    digest = hashlib.md5()
+    decompressor = zlib.decompressobj(wbits=31)
+    in_member = False
+    carry = b""
+    try:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+                data = []
+                # concatenated lanes are several gzip members, start a new member where the last ended
+                while chunk:
+                    data.append(decompressor.decompress(chunk))
+                    in_member = not decompressor.eof
+                    chunk = b""
+                    if decompressor.eof:
+                        chunk = decompressor.unused_data
+                        decompressor = zlib.decompressobj(wbits=31)
+                # check the complete records and carry the rest over to the next chunk
+                lines = (carry + b"".join(data)).split(b"\n")
+                n_complete = (len(lines) - 1) // 4 * 4
+                error = check_records(lines=lines[:n_complete], first_record=result["records"] + 1)
+                if error is not None:
+                    result["error"] = error
+                    return result
+                result["records"] += n_complete // 4
+                carry = b"\n".join(lines[n_complete:])
+    except zlib.error as e:
+        result["error"] = f"corrupt gzip stream: {e}"
+        return result
+    # a member still expecting input means the file was cut short
+    if in_member:
+        result["error"] = "truncated gzip stream"
+        return result
+    lines = carry.split(b"\n")
+    if lines[-1] == b"":
+        lines = lines[:-1]
+    if len(lines) % 4 != 0:
+        result["error"] = f"truncated record after record {result['records']}"
+        return result
+    error = check_records(lines=lines, first_record=result["records"] + 1)
+    if error is not None:
+        result["error"] = error
+        return result
+    result["records"] += len(lines) // 4
+    if result["records"] == 0:
+        result["error"] = "no records"
+        return result
+    result["md5"] = digest.hexdigest()
+    return result
+
+
+def load_validation_cache(filename: str) -> Dict[str, Dict]:
+    # earlier results keyed by the resolved path of each input
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def save_validation_cache(filename: str, cache: Dict[str, Dict]) -> None:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    partial = os.path.join(os.path.dirname(filename), PARTIAL_PREFIX + os.path.basename(filename))
+    with open(partial, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(partial, filename)
+
+
+def is_cached(cache: Dict[str, Dict], filename: str) -> bool:
+    # unchanged inputs keep the size and modification time they were validated with
+    entry = cache.get(os.path.realpath(filename))
+    if entry is None:
+        return False
+    stat = os.stat(filename)
+    return entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+
+def validate_fastqs(
+    filenames: List[str], cache_filename: str, n_cores: int, fail_fast: bool
+) -> Dict[str, Dict]:
+    # validate every uncached file on a process pool, one file per task
+    cache = load_validation_cache(filename=cache_filename)
+    pending = [filename for filename in filenames if not is_cached(cache=cache, filename=filename)]
+    logger.info(
+        f"Validating N={len(pending)} FASTQs, N={len(filenames) - len(pending)} unchanged since they were last validated"
+    )
+    failed = None
+    executor = ProcessPoolExecutor(max_workers=max(1, min(n_cores, len(pending))))
+    futures = {}
+    try:
+        futures = {executor.submit(validate_fastq, filename): filename for filename in pending}
+        for future in as_completed(futures):
+            filename = futures[future]
+            result = future.result()
+            cache[os.path.realpath(filename)] = result
+            if result["error"] is not None:
+                logger.info(f"Invalid FASTQ {filename}: {result['error']}")
+                # stop scheduling the remaining files once the run is bound to fail
+                if fail_fast:
+                    failed = filename
+                    break
+    finally:
+        # cancel the files not started yet, shutdown(cancel_futures=True) needs Python 3.9
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        save_validation_cache(filename=cache_filename, cache=cache)
+    if failed is not None:
+        raise ValueError(f"Invalid FASTQ {failed}: {cache[os.path.realpath(failed)]['error']}")
+    return {filename: cache[os.path.realpath(filename)] for filename in filenames}
+
+
+def check_pairs(
+    results: Dict[str, Dict], r1_fastq_suffix: str, r2_fastq_suffix: str
+) -> Dict[str, str]:
+    # problem of each read pair keyed by its read1 file, covering both files and their record counts
+    problems = {}
+    for r1_filename in [filename for filename in results if filename.endswith(r1_fastq_suffix)]:
+        r2_filename = r1_filename.replace(r1_fastq_suffix, r2_fastq_suffix)
+        r1, r2 = results[r1_filename], results.get(r2_filename)
+        if r2 is None:
+            problems[r1_filename] = f"missing read2 {r2_filename}"
+        elif r1["error"] is not None:
+            problems[r1_filename] = f"read1 {r1['error']}"
+        elif r2["error"] is not None:
+            problems[r1_filename] = f"read2 {r2['error']}"
+        elif r1["records"] != r2["records"]:
+            problems[r1_filename] = f"read1 has {r1['records']} records but read2 has {r2['records']}"
+    return problems
+
+
+def write_validation_report(
+    results: Dict[str, Dict], problems: Dict[str, str], report_filename: str, checksum_filename: str
+) -> None:
+    # table of every input and an md5sum compatible checksum list of the valid ones
+    os.makedirs(os.path.dirname(report_filename), exist_ok=True)
+    with open(report_filename, "w") as f:
+        f.write("File\tSize\tRecords\tMD5\tError\n")
+        for filename, result in sorted(results.items()):
+            error = result["error"] or problems.get(filename, "")
+            f.write(f"{filename}\t{result['size']}\t{result['records']}\t{result['md5']}\t{error}\n")
+    with open(checksum_filename, "w") as f:
+        for filename, result in sorted(results.items()):
+            if result["md5"] is not None:
+                f.write(f"{result['md5']}  {filename}\n")
+    logger.info(f"Input validation written to {report_filename} and {checksum_filename}, N={len(problems)} invalid pairs")